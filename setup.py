@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup, Command
+from setuptools import setup, Command
 from unittest import TextTestRunner, TestLoader
 import os
 import os.path
@@ -34,6 +34,8 @@ setup(
     entry_points={
         'console_scripts': ['tornado_proxy = tornado_proxy.__main__:main', ]
     },
-    install_requires=['tornado'],
+    install_requires=['tornado>=6'],
+    extras_require={'uvloop': ['uvloop']},
+    python_requires='>=3.7',
     packages=['tornado_proxy'],
 )
@@ -1,34 +1,49 @@
 #!/usr/bin/env python
 
+import asyncio
+import collections
+import errno
+import gzip
+import json
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
-import urllib
 import time
 import unittest
-import urllib2
+import unittest.mock as mock
+import urllib.parse
+import urllib.request
 
 import tornado.httpclient
-import tornado.ioloop
+import tornado.iostream
+import tornado.tcpclient
+import tornado.tcpserver
 import tornado.testing
+import tornado.web
 
 sys.path.append('../')
 from tornado_proxy import run_proxy
-from tornado_proxy.cache import WaybackFileSystemCache
+from tornado_proxy.accesslog import AccessLog, read_binary
+from tornado_proxy.cache import (FileSystemCache, HTTPResponse, SegmentStore,
+                                 WaybackFileSystemCache, parse_range,
+                                 request_hash)
+from tornado_proxy.cluster import HashRing, PeerCluster
+from tornado_proxy.prefetch import Prefetcher, SubresourceParser, site
+from tornado_proxy.profiling import Diagnostics, PhaseTimer, phase
 
 
 class TestStandaloneProxy(unittest.TestCase):
     def setUp(self):
-        self.proxy = subprocess.Popen(['python', 'tornado_proxy/proxy.py',
-            '8888'])
-        proxy_support = urllib2.ProxyHandler({
+        self.proxy = subprocess.Popen([sys.executable, '-m', 'tornado_proxy',
+            '--port', '8888'])
+        proxy_support = urllib.request.ProxyHandler({
             "https": "http://localhost:8888",
             "http": "http://localhost:8888"
         })
-        opener = urllib2.build_opener(proxy_support)
-        urllib2.install_opener(opener)
+        opener = urllib.request.build_opener(proxy_support)
+        urllib.request.install_opener(opener)
         # make sure the subprocess started listening on the port
         time.sleep(1)
 
@@ -39,33 +54,37 @@ class TestStandaloneProxy(unittest.TestCase):
 
     def test(self):
         base_url = '//httpbin.org/'
-        urllib2.urlopen('https:' + base_url + 'get').read()
-        urllib2.urlopen('http:' + base_url + 'get').read()
-        urllib2.urlopen('https:' + base_url + 'post', '').read()
-        urllib2.urlopen('http:' + base_url + 'post', '').read()
+        urllib.request.urlopen('https:' + base_url + 'get').read()
+        urllib.request.urlopen('http:' + base_url + 'get').read()
+        urllib.request.urlopen('https:' + base_url + 'post', b'').read()
+        urllib.request.urlopen('http:' + base_url + 'post', b'').read()
 
 
-class TestTornadoProxy(unittest.TestCase):
+class TestTornadoProxy(tornado.testing.AsyncTestCase):
     def setUp(self):
-        self.ioloop = tornado.ioloop.IOLoop.instance()
-        run_proxy(8889, start_ioloop=False)
+        super(TestTornadoProxy, self).setUp()
+        self.server = run_proxy(8889, start_ioloop=False)
 
     def tearDown(self):
-        pass
-
-    def test(self):
-        def handle_response(resp):
-            self.assertIsNone(resp.error)
-            self.ioloop.stop()
+        self.server.stop()
+        super(TestTornadoProxy, self).tearDown()
 
+    @tornado.testing.gen_test
+    async def test(self):
         tornado.httpclient.AsyncHTTPClient.configure(
             "tornado.curl_httpclient.CurlAsyncHTTPClient")
         client = tornado.httpclient.AsyncHTTPClient()
 
         req = tornado.httpclient.HTTPRequest('http://httpbin.org/',
             proxy_host='127.0.0.1', proxy_port=8889)
-        client.fetch(req, handle_response)
-        self.ioloop.start()
+        resp = await client.fetch(req)
+        self.assertIsNone(resp.error)
+
+
+class TestRunProxy(unittest.TestCase):
+    def test_uvloop_needs_own_loop(self):
+        self.assertRaises(ValueError, run_proxy, 8889, start_ioloop=False,
+                          uvloop=True)
 
 
 class TestWaybackProxy(tornado.testing.AsyncTestCase):
@@ -73,14 +92,15 @@ class TestWaybackProxy(tornado.testing.AsyncTestCase):
         super(TestWaybackProxy, self).setUp()
         self.cache_dir = tempfile.mkdtemp('-wayback')
         self.cache = WaybackFileSystemCache(self.cache_dir)
-        run_proxy(8889, start_ioloop=False, cache=self.cache)
+        self.server = run_proxy(8889, start_ioloop=False, cache=self.cache)
 
     def tearDown(self):
+        self.server.stop()
         super(TestWaybackProxy, self).tearDown()
         shutil.rmtree(self.cache_dir)
 
     @tornado.testing.gen_test
-    def test(self):
+    async def test(self):
         tornado.httpclient.AsyncHTTPClient.configure(
             "tornado.curl_httpclient.CurlAsyncHTTPClient")
         client = tornado.httpclient.AsyncHTTPClient()
@@ -89,34 +109,34 @@ class TestWaybackProxy(tornado.testing.AsyncTestCase):
         req = tornado.httpclient.HTTPRequest(
             "http://respondto.it/test-tornado-proxy?view",
             headers={"Content-Type": "application/x-www-form-urlencoded"},
-            method='POST', body=urllib.urlencode({
+            method='POST', body=urllib.parse.urlencode({
                 "json": "{\"foo\": \"baz\"}",
                 "xml": ""
             }))
-        response = yield client.fetch(req)
+        response = await client.fetch(req)
         req = tornado.httpclient.HTTPRequest(
             "http://respondto.it/test-tornado-proxy.json",
             proxy_host='127.0.0.1', proxy_port=8889)
-        response = yield client.fetch(req)
-        self.assertEqual(response.body, "{\"foo\": \"baz\"}")
+        response = await client.fetch(req)
+        self.assertEqual(response.body, b"{\"foo\": \"baz\"}")
         cache_key = response.headers['X-Proxy-Cache-Key']
 
         # now change the value
         req = tornado.httpclient.HTTPRequest(
             "http://respondto.it/test-tornado-proxy?view",
             headers={"Content-Type": "application/x-www-form-urlencoded"},
-            method='POST', body=urllib.urlencode({
+            method='POST', body=urllib.parse.urlencode({
                 "json": "{\"bar\": \"foo\"}",
                 "xml": "    "
             }))
-        response = yield client.fetch(req)
+        response = await client.fetch(req)
 
         # and the value shouldn't have changed
         req = tornado.httpclient.HTTPRequest(
             "http://respondto.it/test-tornado-proxy.json",
             proxy_host='127.0.0.1', proxy_port=8889)
-        response = yield client.fetch(req)
-        self.assertEqual(response.body, "{\"foo\": \"baz\"}")
+        response = await client.fetch(req)
+        self.assertEqual(response.body, b"{\"foo\": \"baz\"}")
         self.assertEqual(response.headers['X-Proxy-Cache-Key'], cache_key)
 
         # now delete the cached value
@@ -128,10 +148,731 @@ class TestWaybackProxy(tornado.testing.AsyncTestCase):
         req = tornado.httpclient.HTTPRequest(
             "http://respondto.it/test-tornado-proxy.json",
             proxy_host='127.0.0.1', proxy_port=8889)
-        response = yield client.fetch(req)
-        self.assertEqual(response.body, "{\"bar\": \"foo\"}")
+        response = await client.fetch(req)
+        self.assertEqual(response.body, b"{\"bar\": \"foo\"}")
         self.assertNotEqual(response.headers['X-Proxy-Cache-Key'], cache_key)
 
 
+class TestCacheIntegrity(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestCacheIntegrity, self).setUp()
+        self.cache_dir = tempfile.mkdtemp('-integrity')
+        self.cache = WaybackFileSystemCache(self.cache_dir)
+
+    def tearDown(self):
+        super(TestCacheIntegrity, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def response(self, url):
+        return HTTPResponse(url, None, 200, {
+            'Content-Type': 'text/plain; charset=utf-8'}, 'hello')
+
+    def test_quarantine(self):
+        url = 'http://example.com/'
+        request = tornado.httpclient.HTTPRequest(url)
+        self.cache[request] = self.response(url)
+        response = self.cache.get(tornado.httpclient.HTTPRequest(url))
+        self.assertEqual(response.body, b'hello')
+
+        path = os.path.join(self.cache_dir, request._wb_path)
+        with gzip.open(path) as f:
+            data = f.read()
+        with gzip.open(path, 'wb') as f:
+            f.write(data.replace(b'hello', b'jello'))
+        self.assertIsNone(self.cache.get(tornado.httpclient.HTTPRequest(url)))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            os.listdir(os.path.join(self.cache_dir, 'quarantine')),
+            [os.path.basename(path)])
+
+    def test_quarantine_keeps_older_versions(self):
+        url = 'http://example.com/'
+        now = int(time.time())
+        paths = []
+        for timestamp in (now - 100, now - 10):
+            request = tornado.httpclient.HTTPRequest(url)
+            request._wb_force = True
+            request._wb_timestamp = timestamp
+            self.cache[request] = self.response(url)
+            paths.append(os.path.join(self.cache_dir, request._wb_path))
+        with open(paths[1], 'wb') as f:
+            f.write(b'corrupt')
+
+        # the proxy stores the response it fetches after the miss
+        request = tornado.httpclient.HTTPRequest(url)
+        self.assertIsNone(self.cache.get(request))
+        self.cache[request] = HTTPResponse(url, None, 200, {
+            'Content-Type': 'text/plain; charset=utf-8'}, 'fresh')
+        self.assertGreaterEqual(request._wb_timestamp, now)
+
+        request = tornado.httpclient.HTTPRequest(url, headers={
+            'X-Wayback-Timestamp': str(now - 50)})
+        self.assertEqual(self.cache[request].body, b'hello')
+        self.assertEqual(request._wb_timestamp, now - 100)
+        self.assertEqual(
+            self.cache.get(tornado.httpclient.HTTPRequest(url)).body,
+            b'fresh')
+
+    def test_read_error(self):
+        url = 'http://example.com/'
+        request = tornado.httpclient.HTTPRequest(url)
+        self.cache[request] = self.response(url)
+        path = os.path.join(self.cache_dir, request._wb_path)
+        error = OSError(errno.EMFILE, 'Too many open files')
+        with mock.patch('gzip.open', side_effect=error):
+            self.assertIsNone(
+                self.cache.get(tornado.httpclient.HTTPRequest(url)))
+        # a healthy file isn't quarantined for an error unrelated to it
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(
+            self.cache.get(tornado.httpclient.HTTPRequest(url)).body,
+            b'hello')
+
+    def test_write_error(self):
+        url = 'http://example.com/'
+        request = tornado.httpclient.HTTPRequest(url)
+        error = OSError(errno.ENOSPC, 'No space left on device')
+        with mock.patch('gzip.open', side_effect=error):
+            self.cache[request] = self.response(url)
+        rows = self.cache.db.execute("SELECT key, timestamp FROM idx")
+        self.assertEqual(rows.fetchall(), [])
+
+    @tornado.testing.gen_test
+    async def test_reconcile(self):
+        # a file that didn't make it into the index
+        orphan = os.path.join('ab', 'cd', 'abcd' * 8 + '-1234.gz')
+        self.cache._set(orphan, self.response('http://example.com/orphan'))
+        # a write interrupted by a crash
+        tmp = os.path.join(self.cache_dir, orphan + '.1.tmp')
+        open(tmp, 'w').close()
+        # an index row without a file
+        self.cache.db.execute(
+            "INSERT INTO idx (key, timestamp) VALUES (?, ?);",
+            ('ef' * 16, 1234))
+        self.cache.db.commit()
+
+        stats = await self.cache.reconcile()
+        self.assertEqual(stats, {'indexed': 1, 'temporary': 1, 'missing': 1})
+        # a file deleted after it was listed isn't indexed again
+        deleted = os.path.join(self.cache_dir, 'ab', 'cd',
+                               'abcd' * 8 + '-5678.gz')
+        self.cache._reconcile_file(deleted, os.path.basename(deleted), stats)
+        self.assertEqual(stats['indexed'], 1)
+        self.assertFalse(os.path.exists(tmp))
+        rows = self.cache.db.execute("SELECT key, timestamp FROM idx")
+        self.assertEqual(rows.fetchall(), [('abcd' * 8, 1234)])
+
+
+class RangeOriginHandler(tornado.web.RequestHandler):
+    """Serves a fixed object with Range support, answering an If-Range that
+    doesn't match (or is weak) with the whole object like nginx does"""
+
+    last_modified = 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+    def initialize(self, data, etag, requests):
+        self.data = data
+        self.etag = etag
+        self.requests = requests
+
+    def get(self):
+        self.requests.append(self.request.headers.get('Range'))
+        self.set_header('ETag', self.etag)
+        self.set_header('Last-Modified', self.last_modified)
+        self.set_header('Content-Type', 'application/octet-stream')
+        byte_range = parse_range(self.request.headers.get('Range'),
+                                 len(self.data))
+        if_range = self.request.headers.get('If-Range')
+        if if_range is not None and (if_range.startswith('W/') or if_range
+                                     not in (self.etag, self.last_modified)):
+            byte_range = None
+        if byte_range is None:
+            self.write(self.data)
+            return
+        start, end = byte_range
+        self.set_status(206)
+        self.set_header('Content-Range',
+                        'bytes %d-%d/%d' % (start, end, len(self.data)))
+        self.write(self.data[start:end + 1])
+
+
+class TestSegments(tornado.testing.AsyncTestCase):
+    segment_size = 1000
+
+    def setUp(self):
+        super(TestSegments, self).setUp()
+        tornado.httpclient.AsyncHTTPClient.configure(
+            "tornado.curl_httpclient.CurlAsyncHTTPClient")
+        self.data = bytes(range(256)) * 10
+        self.requests = []
+        self.cache_dir = tempfile.mkdtemp('-segments')
+        self.store = SegmentStore(self.cache_dir,
+                                  segment_size=self.segment_size)
+        self.origin = self.start_origin(8892, '"strong"')
+        self.server = run_proxy(8893, start_ioloop=False,
+                                segments=self.store)
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.origin.stop()
+        super(TestSegments, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    def start_origin(self, port, etag):
+        origin = tornado.web.Application([
+            (r'/object', RangeOriginHandler, {
+                'data': self.data, 'etag': etag, 'requests': self.requests})])
+        return origin.listen(port)
+
+    def fetch(self, port=8892, **kwargs):
+        return self.client.fetch(tornado.httpclient.HTTPRequest(
+            'http://127.0.0.1:%d/object' % port, proxy_host='127.0.0.1',
+            proxy_port=8893, **kwargs), raise_error=False)
+
+    def key(self):
+        return self.store.hash_request(
+            tornado.httpclient.HTTPRequest('http://127.0.0.1:8892/object'))
+
+    @tornado.testing.gen_test
+    async def test_full(self):
+        response = await self.fetch()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data)
+        key = self.key()
+        self.assertEqual(self.store.get_index(key)['length'], len(self.data))
+        for segment in range(3):
+            self.assertTrue(self.store.has_segment(key, segment))
+        self.assertEqual(len(self.requests), 3)
+
+        # served from the store
+        response = await self.fetch()
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(len(self.requests), 3)
+
+    @tornado.testing.gen_test
+    async def test_range(self):
+        await self.fetch()
+        response = await self.fetch(headers={'Range': 'bytes=990-1009'})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 990-1009/%d' % len(self.data))
+        self.assertEqual(response.body, self.data[990:1010])
+
+    @tornado.testing.gen_test
+    async def test_resume(self):
+        await self.fetch()
+        os.remove(os.path.join(self.cache_dir, self.key(), '00000001'))
+        del self.requests[:]
+        response = await self.fetch()
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(self.requests, ['bytes=1000-1999'])
+
+    @tornado.testing.gen_test
+    async def test_changed(self):
+        await self.fetch()
+        key = self.key()
+        os.remove(os.path.join(self.cache_dir, key, '00000001'))
+        # the origin answers If-Range with the whole new object, which is
+        # larger than a segment
+        self.origin.stop()
+        await self.origin.close_all_connections()
+        self.origin = self.start_origin(8892, '"changed"')
+        with self.assertRaises(tornado.httpclient.HTTPClientError):
+            # cut short after the first segment
+            await self.fetch()
+        self.assertIsNone(self.store.get_index(key))
+
+        response = await self.fetch()
+        self.assertEqual(response.body, self.data)
+
+    @tornado.testing.gen_test
+    async def test_weak_etag(self):
+        # If-Range falls back to Last-Modified
+        self.origin.stop()
+        self.origin = self.start_origin(8894, 'W/"weak"')
+        response = await self.fetch(port=8894)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(len(self.requests), 3)
+
+
+class TestParseRange(unittest.TestCase):
+    def test(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 100))
+        self.assertEqual(parse_range('bytes=10-19', 100), (10, 19))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def test(self):
+        # phases outside a timed request are ignored
+        with phase('ignored'):
+            pass
+        timer = PhaseTimer()
+        timer.activate()
+        with phase('upstream'):
+            with phase('sqlite'):
+                pass
+        with phase('upstream'):
+            pass
+        self.assertEqual(list(timer.phases), ['sqlite', 'upstream'])
+        self.assertGreaterEqual(timer.elapsed(), timer.phases['upstream'])
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp('-accesslog')
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test(self):
+        path = os.path.join(self.log_dir, 'access.log')
+        log = AccessLog(path, format='binary', capacity=2)
+        record = (1234.5, 'GET', 'http://example.com/', 200, 'ab/cd/abcd.gz',
+                  'hit', None, 42, 1234, None, 0.25)
+        log.record(record)
+        log.record(record)
+        log.record(record)
+        log.close()
+        self.assertEqual(log.dropped, 1)
+        with open(path, 'rb') as f:
+            records = list(read_binary(f))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['url'], 'http://example.com/')
+        self.assertEqual(records[0]['cache_status'], 'hit')
+        self.assertIsNone(records[0]['upstream_time'])
+        self.assertEqual(records[0]['wayback_timestamp'], 1234)
+
+
+class EchoServer(tornado.tcpserver.TCPServer):
+    async def handle_stream(self, stream, address):
+        try:
+            while True:
+                await stream.write(await stream.read_bytes(1024, partial=True))
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+class TestTunnelAccessLog(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestTunnelAccessLog, self).setUp()
+        self.log_dir = tempfile.mkdtemp('-accesslog')
+        self.path = os.path.join(self.log_dir, 'access.log')
+        self.access_log = AccessLog(self.path)
+        self.echo = EchoServer()
+        self.echo.listen(8895)
+        self.server = run_proxy(8896, start_ioloop=False,
+                                access_log=self.access_log)
+
+    def tearDown(self):
+        self.server.stop()
+        self.echo.stop()
+        self.access_log.close()
+        super(TestTunnelAccessLog, self).tearDown()
+        shutil.rmtree(self.log_dir)
+
+    async def tunnel(self, port):
+        stream = await tornado.tcpclient.TCPClient().connect('127.0.0.1',
+                                                             8896)
+        await stream.write(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\n'
+                           b'Host: 127.0.0.1:%d\r\n\r\n' % (port, port))
+        status = await stream.read_until(b'\r\n\r\n')
+        return stream, status
+
+    @tornado.testing.gen_test
+    async def test(self):
+        stream, status = await self.tunnel(8895)
+        self.assertIn(b' 200 ', status)
+        await stream.write(b'hello')
+        self.assertEqual(await stream.read_bytes(5), b'hello')
+        stream.close()
+
+        # nothing listens on this port
+        stream, status = await self.tunnel(8897)
+        self.assertIn(b' 502 ', status)
+        stream.close()
+
+        while self.access_log.recorded < 2:
+            await asyncio.sleep(0.01)
+        self.access_log.close()
+        with open(self.path) as f:
+            records = sorted((json.loads(line) for line in f),
+                             key=lambda record: record['status'])
+        self.assertEqual([r['status'] for r in records], [200, 502])
+        self.assertEqual(records[0]['bytes'], 5)
+        self.assertIsNotNone(records[0]['tunnel_duration'])
+        self.assertIsNone(records[1]['tunnel_duration'])
+
+
+class TestRejectedRequest(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestRejectedRequest, self).setUp()
+        tornado.httpclient.AsyncHTTPClient.configure(
+            "tornado.curl_httpclient.CurlAsyncHTTPClient")
+        self.log_dir = tempfile.mkdtemp('-accesslog')
+        self.path = os.path.join(self.log_dir, 'access.log')
+        self.access_log = AccessLog(self.path)
+        self.server = run_proxy(8903, start_ioloop=False,
+                                diagnostics=Diagnostics(slow_threshold=0),
+                                access_log=self.access_log)
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.access_log.close()
+        super(TestRejectedRequest, self).tearDown()
+        shutil.rmtree(self.log_dir)
+
+    @tornado.testing.gen_test
+    async def test(self):
+        # Tornado answers unsupported methods without calling prepare()
+        with self.assertLogs('tornado.proxy.profiling', 'WARNING') as logs:
+            response = await self.client.fetch(
+                tornado.httpclient.HTTPRequest(
+                    'http://127.0.0.1:8901/', method='PUT', body=b'',
+                    proxy_host='127.0.0.1', proxy_port=8903),
+                raise_error=False)
+            self.assertEqual(response.code, 405)
+            await asyncio.sleep(0.01)
+        self.assertIn('PUT', logs.output[0])
+
+        self.access_log.close()
+        with open(self.path) as f:
+            record = json.loads(f.read())
+        self.assertEqual(record['method'], 'PUT')
+        self.assertEqual(record['status'], 405)
+        self.assertEqual(record['cache_status'], 'none')
+
+
+class TestHashRing(unittest.TestCase):
+    def test(self):
+        nodes = ['http://node%d:8888' % i for i in range(4)]
+        ring = HashRing(nodes)
+        keys = ['key%d' % i for i in range(1000)]
+        owners = dict((key, ring.owner(key)) for key in keys)
+        self.assertEqual(set(owners.values()), set(nodes))
+        self.assertEqual(sorted(ring.nodes_for('key0')), sorted(nodes))
+
+        # removing a node only moves the keys it owned
+        smaller = HashRing(nodes[:3])
+        for key in keys:
+            if owners[key] != nodes[3]:
+                self.assertEqual(smaller.owner(key), owners[key])
+
+
+class CountingOriginHandler(tornado.web.RequestHandler):
+    """Answers /<status>/<name> with that status, counting requests"""
+
+    def initialize(self, requests):
+        self.requests = requests
+
+    def get(self, status, name):
+        self.requests[self.request.path] += 1
+        self.set_status(int(status))
+        self.write('%s %s' % (status, name))
+
+
+class TestPeerCluster(tornado.testing.AsyncTestCase):
+    ports = (8899, 8900)
+
+    def setUp(self):
+        super(TestPeerCluster, self).setUp()
+        tornado.httpclient.AsyncHTTPClient.configure(
+            "tornado.curl_httpclient.CurlAsyncHTTPClient")
+        self.requests = collections.Counter()
+        origin = tornado.web.Application([
+            (r'/(\d+)/(.*)', CountingOriginHandler,
+             {'requests': self.requests})])
+        self.origin = origin.listen(8898)
+        nodes = ['http://127.0.0.1:%d' % port for port in self.ports]
+        self.cache_dirs = []
+        self.caches = []
+        self.clusters = []
+        self.servers = []
+        for node, port in zip(nodes, self.ports):
+            self.cache_dirs.append(tempfile.mkdtemp('-cluster'))
+            self.caches.append(FileSystemCache(self.cache_dirs[-1]))
+            self.clusters.append(PeerCluster(node, nodes))
+            self.servers.append(run_proxy(
+                port, start_ioloop=False, cache=self.caches[-1],
+                cluster=self.clusters[-1]))
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    def tearDown(self):
+        self.client.close()
+        for cluster, server in zip(self.clusters, self.servers):
+            cluster.stop()
+            server.stop()
+        self.origin.stop()
+        super(TestPeerCluster, self).tearDown()
+        for cache_dir in self.cache_dirs:
+            shutil.rmtree(cache_dir)
+
+    def urls(self, status, owner):
+        """Yields origin URLs owned by the node at index owner"""
+        for i in range(1000):
+            url = 'http://127.0.0.1:8898/%d/%d' % (status, i)
+            key = request_hash(tornado.httpclient.HTTPRequest(url))
+            if self.clusters[0].ring.owner(key) == \
+                    self.clusters[owner].node:
+                yield url
+
+    def fetch(self, url, node):
+        return self.client.fetch(tornado.httpclient.HTTPRequest(
+            url, proxy_host='127.0.0.1', proxy_port=self.ports[node]),
+            raise_error=False)
+
+    async def stored(self, url, node):
+        """Waits for the background store of a response at a node"""
+        while tornado.httpclient.HTTPRequest(url) not in self.caches[node]:
+            await asyncio.sleep(0.01)
+
+    @tornado.testing.gen_test
+    async def test_lookup_and_store(self):
+        url = next(self.urls(200, owner=1))
+        response = await self.fetch(url, 0)
+        self.assertEqual(response.body,
+                         b'200 ' + url.rsplit('/', 1)[1].encode())
+        # stored at the owner only
+        await self.stored(url, 1)
+        self.assertNotIn(tornado.httpclient.HTTPRequest(url), self.caches[0])
+
+        for node in (1, 0):
+            response = await self.fetch(url, node)
+            self.assertEqual(response.code, 200)
+        self.assertEqual(sum(self.requests.values()), 1)
+
+    @tornado.testing.gen_test
+    async def test_prefetch(self):
+        prefetcher = Prefetcher(self.caches[0], cluster=self.clusters[0])
+        url = next(self.urls(200, owner=1))
+        for i in range(2):
+            prefetcher.enqueue(url)
+            while prefetcher.in_flight:
+                await asyncio.sleep(0.01)
+        # stored at the owner, and found there the second time
+        self.assertIn(tornado.httpclient.HTTPRequest(url), self.caches[1])
+        self.assertNotIn(tornado.httpclient.HTTPRequest(url), self.caches[0])
+        self.assertEqual(prefetcher.counts['fetched'], 1)
+        self.assertEqual(prefetcher.counts['cached'], 1)
+        self.assertEqual(sum(self.requests.values()), 1)
+
+    @tornado.testing.gen_test
+    async def test_cached_error(self):
+        url = next(self.urls(503, owner=1))
+        await self.fetch(url, 1)
+        await self.stored(url, 1)
+        for i in range(3):
+            response = await self.fetch(url, 0)
+            self.assertEqual(response.code, 503)
+        # served by the owner's cache, which isn't a failure of the owner
+        self.assertEqual(sum(self.requests.values()), 1)
+        self.assertTrue(self.clusters[0].is_healthy(self.clusters[1].node))
+
+    @tornado.testing.gen_test
+    async def test_failover(self):
+        urls = self.urls(200, owner=1)
+        self.servers[1].stop()
+        await self.servers[1].close_all_connections()
+        peer = self.clusters[1].node
+        for i in range(2):
+            url = next(urls)
+            response = await self.fetch(url, 0)
+            self.assertEqual(response.code, 200)
+            # the store at the peer failed, so the response is kept locally
+            await self.stored(url, 0)
+        self.assertFalse(self.clusters[0].is_healthy(peer))
+        self.assertIsNone(self.clusters[0].owner(request_hash(
+            tornado.httpclient.HTTPRequest(next(urls)))))
+
+
+class SlowCacheHandler(tornado.web.RequestHandler):
+    """A peer's /cache/ endpoint taking 0.3s to send a cached body"""
+
+    async def get(self):
+        self.set_header('X-Proxy-Cache-Key', 'ab/cd/abcd.gz')
+        self.write('slow')
+        await self.flush()
+        await asyncio.sleep(0.3)
+        self.write(' body')
+
+
+class TestPeerTimeouts(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestPeerTimeouts, self).setUp()
+        peer = tornado.web.Application([(r'/cache/', SlowCacheHandler)])
+        self.peer = peer.listen(8904)
+
+    def tearDown(self):
+        self.peer.stop()
+        super(TestPeerTimeouts, self).tearDown()
+
+    @tornado.testing.gen_test
+    async def test(self):
+        peer = 'http://127.0.0.1:8904'
+        request = tornado.httpclient.HTTPRequest('http://example.com/')
+        # the transfer of a cached body isn't bound by the health timeout
+        cluster = PeerCluster('http://127.0.0.1:8905', [peer], timeout=0.1)
+        response = await cluster.lookup(peer, request)
+        self.assertEqual(response.body, b'slow body')
+
+        # and a transfer timing out after the peer answered isn't a failure
+        cluster = PeerCluster('http://127.0.0.1:8905', [peer], timeout=0.1,
+                              lookup_timeout=0.1)
+        for i in range(cluster.max_failures):
+            self.assertIsNone(await cluster.lookup(peer, request))
+        self.assertTrue(cluster.is_healthy(peer))
+
+
+class TestSubresourceParser(unittest.TestCase):
+    def test(self):
+        parser = SubresourceParser('http://example.com/dir/page.html')
+        page = (
+            '<html><head><link rel="stylesheet" href="style.css">'
+            '<link rel="alternate" href="/feed.xml">'
+            '<script src="/app.js#main"></script></head>'
+            '<body><img src="a.png" srcset="a-2x.png 2x, /a-3x.png 3x">'
+            '<img src="a.png"><img src="data:image/png;base64,AAAA">'
+            '<a href="/other.html">other</a></body></html>')
+        # fed in small chunks, splitting tags
+        for i in range(0, len(page), 7):
+            parser.feed(page[i:i + 7])
+        parser.close()
+        self.assertEqual(parser.urls, [
+            'http://example.com/dir/style.css',
+            'http://example.com/app.js',
+            'http://example.com/dir/a.png',
+            'http://example.com/dir/a-2x.png',
+            'http://example.com/a-3x.png',
+        ])
+        self.assertEqual(site('http://static.example.com/a.png'),
+                         site('http://example.com/'))
+        self.assertNotEqual(site('http://example.org/'),
+                            site('http://example.com/'))
+        self.assertNotEqual(site('http://10.0.0.1/'),
+                            site('http://192.168.0.1/'))
+        self.assertEqual(site('http://10.0.0.1:8080/'),
+                         site('http://10.0.0.1/'))
+
+
+class HeldOriginHandler(tornado.web.RequestHandler):
+    """Serves /page, an HTML page referencing /res/0 to /res/2, and holds
+    /res/ responses until the release event is set"""
+
+    def initialize(self, requests, release):
+        self.requests = requests
+        self.release = release
+
+    async def get(self, path):
+        self.requests[path] += 1
+        if path == 'page':
+            self.set_header('Content-Type', 'text/html')
+            self.write('<img src="/res/0"><img src="/res/1">'
+                       '<script src="/res/2"></script>'
+                       '<img src="http://example.org/res/3">'
+                       '<img src="https://127.0.0.1:8901/res/4">')
+            return
+        await self.release.wait()
+        self.write(path)
+
+
+class TestPrefetcher(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestPrefetcher, self).setUp()
+        tornado.httpclient.AsyncHTTPClient.configure(
+            "tornado.curl_httpclient.CurlAsyncHTTPClient")
+        self.requests = collections.Counter()
+        self.release = asyncio.Event()
+        origin = tornado.web.Application([
+            (r'/(.*)', HeldOriginHandler,
+             {'requests': self.requests, 'release': self.release})])
+        self.origin = origin.listen(8901)
+        self.cache_dir = tempfile.mkdtemp('-prefetch')
+        self.cache = WaybackFileSystemCache(self.cache_dir)
+        self.prefetcher = Prefetcher(self.cache, concurrency=3, per_host=2,
+                                     max_queue=3)
+        self.server = run_proxy(8902, start_ioloop=False, cache=self.cache,
+                                prefetcher=self.prefetcher)
+        self.client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+
+    def tearDown(self):
+        self.release.set()
+        self.client.close()
+        self.server.stop()
+        self.origin.stop()
+        super(TestPrefetcher, self).tearDown()
+        shutil.rmtree(self.cache_dir)
+
+    async def done(self):
+        self.release.set()
+        while self.prefetcher.in_flight or self.prefetcher.queue:
+            await asyncio.sleep(0.01)
+
+    def fetch(self, path, **kwargs):
+        return self.client.fetch(tornado.httpclient.HTTPRequest(
+            'http://127.0.0.1:8901' + path, proxy_host='127.0.0.1',
+            proxy_port=8902, **kwargs))
+
+    @tornado.testing.gen_test
+    async def test_limits(self):
+        urls = ['http://127.0.0.1:8901/res/%d' % i for i in range(6)]
+        self.prefetcher.enqueue(urls[0])
+        self.prefetcher.enqueue(urls[1])
+        # another host has its own limit
+        self.prefetcher.enqueue('http://localhost:8901/res/other')
+        for url in urls[2:]:
+            self.prefetcher.enqueue(url)
+        self.prefetcher.enqueue(urls[2])
+        self.prefetcher.enqueue(urls[0])
+        self.assertEqual(self.prefetcher.stats(), {
+            'queued': 3, 'in_flight': 3, 'fetched': 0, 'cached': 0,
+            'failed': 0, 'dropped': 1, 'replays': 0})
+        self.assertEqual(dict(self.prefetcher.hosts),
+                         {'127.0.0.1:8901': 2, 'localhost:8901': 1})
+
+        await self.done()
+        self.assertEqual(self.prefetcher.counts['fetched'], 6)
+        self.assertEqual(self.requests['res/0'], 1)
+        self.assertEqual(self.requests['res/5'], 0)
+        # already cached
+        self.prefetcher.enqueue(urls[0])
+        await self.done()
+        self.assertEqual(self.prefetcher.counts['cached'], 1)
+
+    @tornado.testing.gen_test
+    async def test_scan(self):
+        await self.fetch('/page')
+        while len(self.prefetcher.in_flight) < 2:
+            await asyncio.sleep(0.01)
+        self.assertEqual(len(self.prefetcher.queue), 1)
+
+        # waits for the prefetch, then is served from the cache
+        fetch = self.fetch('/res/0')
+        await asyncio.sleep(0.05)
+        self.release.set()
+        response = await fetch
+        self.assertEqual(response.body, b'res/0')
+        await self.done()
+        self.assertEqual(self.prefetcher.counts['fetched'], 3)
+        self.assertEqual(self.requests['res/0'], 1)
+        # other sites and https (tunnelled past the cache) are skipped
+        self.assertEqual(self.requests['res/3'], 0)
+        self.assertEqual(self.requests['res/4'], 0)
+
+        # replays of a past version aren't scanned
+        await self.fetch('/page', headers={
+            'X-Wayback-Timestamp': str(int(time.time()))})
+        while not self.prefetcher.counts['replays']:
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.prefetcher.counts['cached'], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,85 @@
 from tornado_proxy.proxy import ProxyHandler  # noqa
 
 
-def run_proxy(port, cache=None, debug=False, start_ioloop=True):
+def run_proxy(port, cache=None, debug=False, start_ioloop=True,
+              segments=None, uvloop=False, diagnostics=None,
+              access_log=None, cluster=None, prefetcher=None):
     """
     Run proxy on the specified port. If start_ioloop is True (default),
-    the tornado IOLoop will be started immediately.
+    an asyncio event loop is started and runs the proxy until interrupted,
+    otherwise the proxy is added to the current loop and its HTTPServer is
+    returned. If uvloop is True the loop is created by uvloop; this requires
+    start_ioloop, callers running their own loop have to create it with
+    uvloop themselves (e.g. uvloop.install() before asyncio.run()). If a
+    SegmentStore is given as segments, large GET responses are stored and
+    served in segments. The slow request log, profiler and blocking detector
+    of diagnostics can be controlled at runtime under /admin/. If an
+    AccessLog is given as access_log, it replaces Tornado's access log. If a
+    PeerCluster is given as cluster, cache misses are looked up in (and
+    stored at) the peer owning the request. If a Prefetcher is given as
+    prefetcher, the subresources of the HTML pages served are fetched into
+    the cache in the background. Caches that support it are reconciled in
+    the background after startup.
     """
+    import asyncio
     if debug:
         from tornado.log import enable_pretty_logging
         enable_pretty_logging()
+    if uvloop and not start_ioloop:
+        raise ValueError("uvloop can't replace the loop of a proxy started "
+                         "with start_ioloop=False")
+    if uvloop:
+        import uvloop as _uvloop
+        asyncio.set_event_loop_policy(_uvloop.EventLoopPolicy())
+    import tornado.ioloop
     import tornado.web
+    from tornado_proxy.profiling import (Diagnostics, DiagnosticsHandler,
+                                         ProfileHandler)
+    if diagnostics is None:
+        diagnostics = Diagnostics()
     handlers = [
-        (r'.*', ProxyHandler, {'cache': cache}),
+        (r'^/admin/diagnostics/$', DiagnosticsHandler,
+         {'diagnostics': diagnostics}),
+        (r'^/admin/profile/$', ProfileHandler, {'diagnostics': diagnostics}),
+        (r'.*', ProxyHandler, {'cache': cache, 'segments': segments,
+                               'diagnostics': diagnostics,
+                               'access_log': access_log,
+                               'cluster': cluster,
+                               'prefetcher': prefetcher}),
     ]
+    settings = {}
+    if access_log is not None:
+        from tornado_proxy.accesslog import AccessLogHandler
+        handlers.insert(0, (r'^/admin/accesslog/$', AccessLogHandler,
+                            {'access_log': access_log}))
+        settings['log_function'] = lambda handler: None
     if cache is not None:
         from tornado_proxy.cache import CacheHandler, CacheListHandler
         handlers.insert(0, (r'^/cache/list/$', CacheListHandler, {'cache': cache}))
         handlers.insert(0, (r'^/cache/$', CacheHandler, {'cache': cache}))
-    app = tornado.web.Application(handlers, debug=debug)
-    app.listen(port)
-    ioloop = tornado.ioloop.IOLoop.instance()
+    if cluster is not None:
+        from tornado_proxy.cluster import PeerHealthHandler
+        handlers.insert(0, (r'^/cluster/health/$', PeerHealthHandler))
+    if prefetcher is not None:
+        from tornado_proxy.prefetch import PrefetchHandler
+        handlers.insert(0, (r'^/admin/prefetch/$', PrefetchHandler,
+                            {'prefetcher': prefetcher}))
+    app = tornado.web.Application(handlers, debug=debug, **settings)
 
-    if start_ioloop:
-        ioloop.start()
+    def start():
+        server = app.listen(port)
+        if cluster is not None:
+            cluster.start()
+        if hasattr(cache, 'reconcile'):
+            # clean up after a crash without delaying startup
+            tornado.ioloop.IOLoop.current().spawn_callback(cache.reconcile)
+        return server
+
+    if not start_ioloop:
+        return start()
+
+    async def serve():
+        start()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
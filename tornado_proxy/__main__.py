@@ -12,6 +12,40 @@ def main():
                         help='the folder to store cache files in (default: '
                         '/tmp/proxy_cache)',
                         default='/tmp/proxy_cache')
+    parser.add_argument('--segments', dest='segments', action='store_true',
+                        default=False,
+                        help='store large responses as segments fetched with '
+                        'parallel range requests')
+    parser.add_argument('--segment-size', dest='segment_size', type=int,
+                        default=4, help='the segment size in MB (default: 4)')
+    parser.add_argument('--uvloop', dest='uvloop', action='store_true',
+                        default=False, help='Run on the uvloop event loop')
+    parser.add_argument('--slow-threshold', dest='slow_threshold',
+                        type=float, default=None,
+                        help='log the phase timings of requests slower than '
+                        'this many seconds')
+    parser.add_argument('--access-log', dest='access_log',
+                        help='the file to write the structured access log to')
+    parser.add_argument('--access-log-format', dest='access_log_format',
+                        help='the access log format (default: json)',
+                        choices=['json', 'binary'], default='json')
+    parser.add_argument('--access-log-sample', dest='access_log_sample',
+                        type=float, default=1.0,
+                        help='the fraction of requests to log (default: 1)')
+    parser.add_argument('--cluster-node', dest='cluster_node',
+                        help='the URL peers reach this proxy at, e.g. '
+                        'http://10.0.0.1:8888')
+    parser.add_argument('--cluster-peers', dest='cluster_peers',
+                        help='comma separated URLs of the other proxies '
+                        'sharing their cache with this one')
+    parser.add_argument('--prefetch', dest='prefetch', action='store_true',
+                        default=False,
+                        help='fetch the subresources of HTML pages into the '
+                        'cache in the background (requires --cache)')
+    parser.add_argument('--prefetch-concurrency', dest='prefetch_concurrency',
+                        type=int, default=4,
+                        help='the number of concurrent prefetches (default: '
+                        '4)')
     args = parser.parse_args()
 
     if args.cache == 'wayback':
@@ -26,9 +60,49 @@ def main():
     else:
         cache = None
 
+    if args.segments:
+        import os.path
+        from tornado_proxy.cache import SegmentStore
+        segments = SegmentStore(os.path.join(args.cache_folder, 'segments'),
+                                segment_size=args.segment_size * 1024 * 1024)
+    else:
+        segments = None
+
+    from tornado_proxy.profiling import Diagnostics
+    diagnostics = Diagnostics(slow_threshold=args.slow_threshold)
+
+    if args.access_log:
+        from tornado_proxy.accesslog import AccessLog
+        access_log = AccessLog(args.access_log, format=args.access_log_format,
+                               sample_rate=args.access_log_sample)
+    else:
+        access_log = None
+
+    if args.cluster_peers:
+        if cache is None:
+            # peers look requests up in the /cache/ endpoint
+            parser.error('--cluster-peers requires --cache')
+        from tornado_proxy.cluster import PeerCluster
+        node = args.cluster_node or 'http://127.0.0.1:%d' % args.port
+        cluster = PeerCluster(node, args.cluster_peers.split(','))
+    else:
+        cluster = None
+
+    if args.prefetch:
+        if cache is None:
+            parser.error('--prefetch requires --cache')
+        from tornado_proxy.prefetch import Prefetcher
+        prefetcher = Prefetcher(cache, cluster=cluster,
+                                concurrency=args.prefetch_concurrency)
+    else:
+        prefetcher = None
+
     from tornado_proxy import run_proxy
-    print ("Starting HTTP proxy on port %d" % args.port)
-    run_proxy(args.port, cache=cache, debug=args.debug)
+    print("Starting HTTP proxy on port %d" % args.port)
+    run_proxy(args.port, cache=cache, debug=args.debug,
+              segments=segments, uvloop=args.uvloop,
+              diagnostics=diagnostics, access_log=access_log,
+              cluster=cluster, prefetcher=prefetcher)
 
 if __name__ == '__main__':
     main()
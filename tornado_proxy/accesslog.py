@@ -0,0 +1,226 @@
+"""Structured access log written off the IOLoop
+
+The proxy handlers call AccessLog.record() with a tuple of fields, which only
+appends it to a bounded buffer. A background thread takes the records in
+batches, formats them and appends them to a log file that is rotated by size.
+
+Two formats are supported: ``json`` writes one JSON object per line, and
+``binary`` writes length-prefixed packed records that can be read back with
+read_binary().
+
+When the buffer is full new records are dropped, and records can be sampled
+to reduce the load; both are counted in stats().
+"""
+
+import atexit
+import collections
+import json
+import logging
+import os
+import random
+import struct
+import threading
+
+import tornado.web
+
+logger = logging.getLogger('tornado.proxy.accesslog')
+
+FIELDS = ('time', 'method', 'url', 'status', 'cache_key', 'cache_status',
+          'upstream_time', 'bytes', 'wayback_timestamp', 'tunnel_duration',
+          'duration')
+
+# 'peer' is a hit in the cache of the peer owning the key
+CACHE_STATUSES = ('none', 'hit', 'miss', 'stale', 'peer')
+
+# time, status, cache status, bytes, wayback timestamp, upstream time, tunnel
+# duration, total duration, then the lengths of the method, url and cache key
+# which follow the fixed part of the record
+_RECORD = struct.Struct('<dHBQqfffHIH')
+_LENGTH = struct.Struct('<I')
+_MISSING = float('nan')
+
+
+def format_json(record):
+    return (json.dumps(dict(zip(FIELDS, record))) + '\n').encode('utf-8')
+
+
+def format_binary(record):
+    (time, method, url, status, cache_key, cache_status, upstream_time,
+     size, wayback_timestamp, tunnel_duration, duration) = record
+    method = method.encode('utf-8')
+    url = url.encode('utf-8')
+    cache_key = (cache_key or '').encode('utf-8')
+    data = _RECORD.pack(
+        time, status, CACHE_STATUSES.index(cache_status), size,
+        -1 if wayback_timestamp is None else wayback_timestamp,
+        _MISSING if upstream_time is None else upstream_time,
+        _MISSING if tunnel_duration is None else tunnel_duration,
+        duration, len(method), len(url), len(cache_key)
+    ) + method + url + cache_key
+    return _LENGTH.pack(len(data)) + data
+
+
+def read_binary(f):
+    """Yields the records of a binary access log file as dicts"""
+    while True:
+        header = f.read(_LENGTH.size)
+        if len(header) < _LENGTH.size:
+            return
+        data = f.read(_LENGTH.unpack(header)[0])
+        (time, status, cache_status, size, wayback_timestamp, upstream_time,
+         tunnel_duration, duration, method_length, url_length,
+         key_length) = _RECORD.unpack_from(data)
+        offset = _RECORD.size
+        strings = []
+        for length in (method_length, url_length, key_length):
+            strings.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        method, url, cache_key = strings
+        yield dict(zip(FIELDS, (
+            time, method, url, status, cache_key or None,
+            CACHE_STATUSES[cache_status],
+            None if upstream_time != upstream_time else upstream_time,
+            size, None if wayback_timestamp == -1 else wayback_timestamp,
+            None if tunnel_duration != tunnel_duration else tunnel_duration,
+            duration)))
+
+
+FORMATS = {
+    'json': format_json,
+    'binary': format_binary,
+}
+
+
+class AccessLog(object):
+    """Buffers access log records and writes them from a background thread
+
+    capacity bounds the number of buffered records, a batch is written every
+    flush_interval seconds or as soon as batch_size records are waiting. The
+    file is rotated when it would grow past max_bytes, keeping backup_count
+    old files as path.1, path.2...
+    """
+
+    def __init__(self, path, format='json', capacity=65536, batch_size=1024,
+                 flush_interval=1.0, sample_rate=1.0,
+                 max_bytes=100 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.format = FORMATS[format]
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        # appending to and popping from a deque are thread safe, so the
+        # IOLoop never waits for the writer
+        self.buffer = collections.deque()
+        self.recorded = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self.written = 0
+        self.errors = 0
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='tornado-proxy-accesslog')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, record):
+        """Queues a tuple of FIELDS to be written"""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            return
+        self.buffer.append(record)
+        self.recorded += 1
+        if len(self.buffer) == self.batch_size:
+            self._wakeup.set()
+
+    def close(self):
+        """Writes out the buffered records and stops the writer thread"""
+        if self._stop:
+            return
+        self._stop = True
+        self._wakeup.set()
+        self._thread.join()
+
+    def stats(self):
+        return {
+            'buffered': len(self.buffer),
+            'recorded': self.recorded,
+            'sampled_out': self.sampled_out,
+            'dropped': self.dropped,
+            'written': self.written,
+            'errors': self.errors,
+            'sample_rate': self.sample_rate,
+        }
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            stop = self._stop
+            while self.buffer:
+                self._write_batch()
+            if stop:
+                return
+
+    def _write_batch(self):
+        chunks = []
+        while self.buffer and len(chunks) < self.batch_size:
+            record = self.buffer.popleft()
+            try:
+                chunks.append(self.format(record))
+            except Exception:
+                logger.exception('Could not format access log record %r',
+                                 record)
+                self.errors += 1
+        data = b''.join(chunks)
+        try:
+            self._rotate(len(data))
+            with open(self.path, 'ab') as f:
+                f.write(data)
+            self.written += len(chunks)
+        except (IOError, OSError):
+            logger.exception('Could not write access log %s', self.path)
+            self.errors += len(chunks)
+
+    def _rotate(self, size):
+        try:
+            current = os.path.getsize(self.path)
+        except OSError:
+            return
+        if not current or current + size <= self.max_bytes:
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = '%s.%d' % (self.path, i)
+            if os.path.exists(source):
+                os.replace(source, '%s.%d' % (self.path, i + 1))
+        if self.backup_count:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+class AccessLogHandler(tornado.web.RequestHandler):
+
+    def initialize(self, access_log):
+        self.access_log = access_log
+
+    def get(self):
+        self.write(self.access_log.stats())
+
+    def post(self):
+        """
+        data = {
+            'sample_rate': 0.1
+        }
+        """
+        data = json.loads(self.request.body)
+        if 'sample_rate' in data:
+            self.access_log.sample_rate = float(data['sample_rate'])
+        self.write(self.access_log.stats())
@@ -1,48 +1,68 @@
+import asyncio
+import base64
 import codecs
+import collections
 import datetime
 import gzip
 import hashlib
 import json
 import logging
 import os.path
+import re
+import shutil
 import sqlite3
-from collections import MutableMapping, namedtuple
+import zlib
+from collections import namedtuple
+from collections.abc import MutableMapping
 
 import tornado.web
 from tornado.httpclient import HTTPError, HTTPRequest
 from tornado.httputil import HTTPHeaders
 
+from tornado_proxy.profiling import phase
+
 logger = logging.getLogger("tornado.proxy.cache")
 
 
-class Cache(MutableMapping):
-    def hash_request(self, request):
+def request_hash(request):
+    """Returns the hex digest identifying a request's url, method and body"""
+    with phase('hash'):
         hash = hashlib.md5()
-        hash.update(request.url)
-        hash.update(request.method)
-        if request.body is not None:
-            hash.update(request.body)
+        hash.update(request.url.encode('utf-8'))
+        hash.update(request.method.encode('utf-8'))
+        body = request.body
+        if body is not None:
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            hash.update(body)
         return hash.hexdigest()
 
+
+class Cache(MutableMapping):
+    def hash_request(self, request):
+        return request_hash(request)
+
     def __contains__(self, request):
         key = self.hash_request(request)
         contains = self._contains(key)
-        logger.info('Checking if request %s is in cache: %s', key, contains)
+        logger.debug('Checking if request %s is in cache: %s', key, contains)
         return contains
 
     def __getitem__(self, request):
         key = self.hash_request(request)
-        logger.info('Returning request %s from cache', key)
-        return self._get(request, key)
+        logger.debug('Returning request %s from cache', key)
+        with phase('cache_read'):
+            return self._get(request, key)
 
     def __setitem__(self, request, response):
         key = self.hash_request(request)
-        logger.info('Putting request %s into cache', key)
-        self._set(key, response)
+        logger.debug('Putting request %s into cache', key)
+        with phase('cache_write'):
+            return self._set(key, response)
 
     def __delitem__(self, request):
         key = self.hash_request(request)
-        logger.info('Deleting %s from cache', key)
+        logger.debug('Deleting %s from cache', key)
         self._del(request, key)
 
     def __iter__(self):
@@ -72,6 +92,17 @@ class SimpleCache(Cache):
 HTTPResponse = namedtuple('HTTPResponse', ['url', 'error', 'code', 'headers', 'body'])
 
 
+HASH_FOLDER = re.compile(r'^[0-9a-f]{2}$')
+
+# raised for corrupt gzip files, Python 3.7 raises a plain OSError
+BadGzipFile = getattr(gzip, 'BadGzipFile', OSError)
+
+
+def body_checksum(body):
+    """Returns the checksum stored with a cached response body"""
+    return '%08x' % zlib.crc32(body.encode('utf-8'))
+
+
 def get_content_charset(headers):
     """Gets the charset of the response body"""
     try:
@@ -93,6 +124,12 @@ class FileSystemCache(Cache):
     STATUS_CODE,ERROR_MESSAGE
     HEADERS_JSON
     BODY
+
+    Files are written to a temporary file and renamed into place, so readers
+    never see a partly written file. The headers include a CRC32 checksum of
+    the body (X-Proxy-Cache-Checksum), which is checked on read together with
+    the gzip trailer; corrupt files are moved to the quarantine folder and
+    treated as a miss.
     """
 
     def __init__(self, root):
@@ -107,8 +144,8 @@ class FileSystemCache(Cache):
         return os.path.exists(path)
 
     def _get(self, request, key):
+        path = os.path.join(self.root, key)
         try:
-            path = os.path.join(self.root, key)
             reader = codecs.getreader("utf-8")
             with gzip.open(path, 'rb') as _f:
                 f = reader(_f)
@@ -120,30 +157,47 @@ class FileSystemCache(Cache):
                 else:
                     error = None
                 headers = HTTPHeaders(json.loads(f.readline()))
-                body = u''
+                body = ''
                 while True:
                     part = f.read()
                     if not part:
                         break
                     body += part
-            headers['X-Proxy-Cache-Key'] = key
-            headers['X-Proxy-Cache-Url'] = url
-            charset = get_content_charset(headers)
-            if charset != 'utf-8':
-                body = body.encode(charset)
-            return HTTPResponse(url, error, code, headers, body)
-        except IOError:
+            checksum = headers.pop('X-Proxy-Cache-Checksum', None)
+            if checksum is not None and checksum != body_checksum(body):
+                raise ValueError('Checksum mismatch')
+        except FileNotFoundError:
             raise KeyError
+        except (EOFError, BadGzipFile, ValueError, zlib.error) as e:
+            self._quarantine(request, key, e)
+            raise KeyError
+        except OSError as e:
+            # e.g. too many open files: the file itself may be fine
+            logger.warning('Could not read cache file %s: %s', key, e)
+            raise KeyError
+        headers['X-Proxy-Cache-Key'] = key
+        headers['X-Proxy-Cache-Url'] = url
+        body = body.encode(get_content_charset(headers))
+        return HTTPResponse(url, error, code, headers, body)
 
     def _set(self, key, val):
+        """Writes a response to its cache file, returning whether it
+        succeeded"""
         val.headers['X-Proxy-Cache-Key'] = key
         path = os.path.join(self.root, key)
         d = os.path.dirname(path)
         if not os.path.exists(d):
             os.makedirs(d)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
         writer = codecs.getwriter('utf-8')
         try:
-            with gzip.open(path, 'wb') as _f:
+            body = val.body
+            if not isinstance(body, str):
+                charset = get_content_charset(val.headers)
+                body = body.decode(charset)
+            headers = dict(val.headers)
+            headers['X-Proxy-Cache-Checksum'] = body_checksum(body)
+            with gzip.open(tmp, 'wb') as _f:
                 f = writer(_f)
                 try:
                     f.write(val.request.url)
@@ -151,23 +205,25 @@ class FileSystemCache(Cache):
                     f.write(val.url)
                 f.write('\n')
                 if val.error:
-                    f.write(unicode(val.error.code))
+                    f.write(str(val.error.code))
                     f.write(',')
                     f.write(val.error.message)
                 else:
-                    f.write(unicode(val.code))
+                    f.write(str(val.code))
                     f.write(',')
                 f.write('\n')
-                f.write(json.dumps(val.headers))
+                f.write(json.dumps(headers))
                 f.write('\n')
-                body = val.body
-                if not isinstance(body, unicode):
-                    charset = get_content_charset(val.headers)
-                    body = body.decode(charset)
                 f.write(body)
+            os.replace(tmp, path)
         except:
             logger.exception('Exception while trying to write cache file')
-            os.remove(path)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        return True
 
     def _del(self, request, key):
         path = os.path.join(self.root, key)
@@ -176,6 +232,58 @@ class FileSystemCache(Cache):
         except OSError:
             pass
 
+    def _quarantine(self, request, key, error):
+        """Moves a corrupt cache file out of the way, keeping it for
+        inspection in the quarantine folder"""
+        logger.warning('Quarantining corrupt cache file %s: %s', key, error)
+        quarantine = os.path.join(self.root, 'quarantine')
+        if not os.path.exists(quarantine):
+            os.makedirs(quarantine)
+        try:
+            os.replace(os.path.join(self.root, key),
+                       os.path.join(quarantine, os.path.basename(key)))
+        except OSError:
+            pass
+
+    def cache_files(self):
+        """Yields the (path, name) of every file in the hash folders"""
+        if not os.path.isdir(self.root):
+            return
+        for top in sorted(os.listdir(self.root)):
+            if not HASH_FOLDER.match(top):
+                continue
+            for sub in sorted(os.listdir(os.path.join(self.root, top))):
+                folder = os.path.join(self.root, top, sub)
+                if not HASH_FOLDER.match(sub) or not os.path.isdir(folder):
+                    continue
+                for name in os.listdir(folder):
+                    yield os.path.join(folder, name), name
+
+    def _reconcile_file(self, path, name, stats):
+        if name.endswith('.tmp'):
+            # left behind by a write interrupted by a crash
+            os.remove(path)
+            stats['temporary'] += 1
+
+    async def reconcile(self, batch_size=100):
+        """Cleans up after a crash, going through the cache files in batches
+        and yielding to the IOLoop in between so requests are served while
+        it runs"""
+        stats = collections.Counter()
+        for i, (path, name) in enumerate(self.cache_files()):
+            try:
+                self._reconcile_file(path, name, stats)
+            except OSError as e:
+                logger.warning('Could not reconcile %s: %s', path, e)
+            if i % batch_size == 0:
+                await asyncio.sleep(0)
+        await self._reconcile_index(batch_size, stats)
+        logger.info('Reconciled cache %s: %s', self.root, dict(stats))
+        return stats
+
+    async def _reconcile_index(self, batch_size, stats):
+        pass
+
 
 class WaybackPageNotFound(Exception):
     def __init__(self, url, timestamp, within=None):
@@ -184,6 +292,9 @@ class WaybackPageNotFound(Exception):
         self.within = within
 
 
+WAYBACK_FILE = re.compile(r'^([0-9a-f]{32})-([0-9]+)\.gz$')
+
+
 class WaybackFileSystemCache(FileSystemCache):
 
     def __init__(self, root, db_file='wayback.db', default_within=2592000):
@@ -253,11 +364,12 @@ class WaybackFileSystemCache(FileSystemCache):
                 args = (now - within, )
                 f = "timestamp > ?"
 
-        c.execute("""SELECT timestamp FROM idx WHERE
-                key=? AND {}
-                ORDER BY timestamp desc
-                LIMIT 1;""".format(f), (request._wb_hash, ) + args)
-        val = c.fetchone()
+        with phase('sqlite'):
+            c.execute("""SELECT timestamp FROM idx WHERE
+                    key=? AND {}
+                    ORDER BY timestamp desc
+                    LIMIT 1;""".format(f), (request._wb_hash, ) + args)
+            val = c.fetchone()
         if val:
             request._wb_insert = False
             request._wb_timestamp = val[0]
@@ -271,46 +383,47 @@ class WaybackFileSystemCache(FileSystemCache):
             request._wb_hash + '-' + str(request._wb_timestamp) + '.gz')
         return request._wb_path
 
-    def _set(self, key, response):
-        # Provide the wayback timestamp in the response headers
-        super(WaybackFileSystemCache, self)._set(key, response)
-        response.headers['X-Wayback-Timestamp'] = \
-            unicode(response.request._wb_timestamp)
-
     def _get(self, request, key):
         # Provide the wayback timestamp in the response headers
         response = super(WaybackFileSystemCache, self)._get(request, key)
         response.headers['X-Wayback-Timestamp'] = \
-            unicode(request._wb_timestamp)
+            str(request._wb_timestamp)
         return response
 
     def __setitem__(self, request, response):
-        super(WaybackFileSystemCache, self).__setitem__(request, response)
-        if request._wb_insert:
-            logger.info("inserting into index")
-            c = self.db.cursor()
-            c.execute(
-                "INSERT INTO idx (key, timestamp) VALUES (?, ?);",
-                (request._wb_hash, request._wb_timestamp))
-            self.db.commit()
+        stored = super(WaybackFileSystemCache, self).__setitem__(
+            request, response)
+        # Provide the wayback timestamp in the response headers. This is done
+        # here rather than in _set as responses posted to CacheHandler don't
+        # have a request
+        response.headers['X-Wayback-Timestamp'] = str(request._wb_timestamp)
+        if stored and request._wb_insert:
+            logger.debug("inserting into index")
+            with phase('sqlite'):
+                c = self.db.cursor()
+                c.execute(
+                    "INSERT INTO idx (key, timestamp) VALUES (?, ?);",
+                    (request._wb_hash, request._wb_timestamp))
+                self.db.commit()
 
     def _del(self, request, key):
         c = self.db.cursor()
         hash = request._wb_hash
         timestamp = request._wb_timestamp
+        # files are removed before their index rows, so that a crash in
+        # between leaves rows without files, which reconcile() removes,
+        # rather than files that it would add back to the index
         if timestamp:
-            c.execute("DELETE FROM idx where key=? AND timestamp=?",
-                      (hash, int(timestamp)))
-            self.db.commit()
             try:
-                os.remove(request._wb_path)
+                os.remove(os.path.join(self.root, request._wb_path))
             except OSError:
                 pass
+            c.execute("DELETE FROM idx where key=? AND timestamp=?",
+                      (hash, int(timestamp)))
+            self.db.commit()
         else:
             c.execute("SELECT timestamp FROM idx WHERE key=?", (hash, ))
             timestamps = c.fetchall()
-            c.execute("DELETE FROM idx where key=?", (hash, ))
-            self.db.commit()
             for (timestamp, ) in timestamps:
                 path = os.path.join(self.root, hash[0:2], hash[2:4],
                                     hash + '-' + str(timestamp) + '.gz')
@@ -318,6 +431,175 @@ class WaybackFileSystemCache(FileSystemCache):
                     os.remove(path)
                 except OSError:
                     pass
+            c.execute("DELETE FROM idx where key=?", (hash, ))
+            self.db.commit()
+
+    def _quarantine(self, request, key, error):
+        super(WaybackFileSystemCache, self)._quarantine(request, key, error)
+        c = self.db.cursor()
+        c.execute("DELETE FROM idx where key=? AND timestamp=?",
+                  (request._wb_hash, request._wb_timestamp))
+        self.db.commit()
+        # a response put back in the cache for this request is a new version,
+        # rather than a replacement of an older one still in the index
+        request._wb_insert = True
+        request._wb_timestamp = int(datetime.datetime.utcnow().strftime("%s"))
+        request._wb_path = os.path.join(
+            request._wb_hash[0:2], request._wb_hash[2:4],
+            request._wb_hash + '-' + str(request._wb_timestamp) + '.gz')
+
+    def _reconcile_file(self, path, name, stats):
+        super(WaybackFileSystemCache, self)._reconcile_file(path, name, stats)
+        match = WAYBACK_FILE.match(name)
+        # the file may have been deleted or quarantined since it was listed
+        if not match or not os.path.exists(path):
+            return
+        # the file was written but the process stopped before adding it to
+        # the index
+        c = self.db.cursor()
+        c.execute("SELECT 1 FROM idx WHERE key=? AND timestamp=?",
+                  (match.group(1), int(match.group(2))))
+        if c.fetchone() is None:
+            c.execute("INSERT INTO idx (key, timestamp) VALUES (?, ?);",
+                      (match.group(1), int(match.group(2))))
+            self.db.commit()
+            stats['indexed'] += 1
+
+    async def _reconcile_index(self, batch_size, stats):
+        """Removes the index rows whose file is missing"""
+        c = self.db.cursor()
+        rowid = 0
+        while True:
+            c.execute("SELECT rowid, key, timestamp FROM idx WHERE rowid > ? "
+                      "ORDER BY rowid LIMIT ?", (rowid, batch_size))
+            rows = c.fetchall()
+            if not rows:
+                return
+            for rowid, hash, timestamp in rows:
+                path = os.path.join(self.root, hash[0:2], hash[2:4],
+                                    hash + '-' + str(timestamp) + '.gz')
+                if not os.path.exists(path):
+                    c.execute("DELETE FROM idx WHERE rowid=?", (rowid, ))
+                    stats['missing'] += 1
+            self.db.commit()
+            await asyncio.sleep(0)
+
+
+def parse_range(value, length):
+    """Parses a single ``Range: bytes=...`` header against an object length
+
+    Returns an inclusive ``(start, end)`` tuple, or None if the header is
+    missing or is not something we serve (e.g. multiple ranges), in which case
+    the whole object should be returned. Raises ValueError if the range can't
+    be satisfied.
+    """
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    start, _, end = value[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            # suffix range: the last N bytes
+            start = max(length - int(end), 0)
+            end = length - 1
+        else:
+            start = int(start)
+            end = min(int(end), length - 1) if end else length - 1
+    except ValueError:
+        return None
+    if start > end or start >= length:
+        raise ValueError('Unsatisfiable range %r' % value)
+    return start, end
+
+
+class SegmentStore(object):
+    """Stores large responses on the filesystem as fixed-size segments
+
+    Each object gets a directory named after the request hash, containing an
+    ``index.json`` file with the response metadata and one file per segment
+    named after the segment number:
+
+    ab/cd/abcd...ef.seg/index.json
+    ab/cd/abcd...ef.seg/00000000
+    ab/cd/abcd...ef.seg/00000001
+
+    Segments and the index are written to a temporary file and renamed into
+    place, so any segment file that exists is complete. Objects can be served
+    while they are still being filled, and an interrupted download resumes
+    from the segments already on disk.
+    """
+
+    # headers kept from the upstream response to be replayed to clients
+    HEADERS = ('Date', 'Cache-Control', 'Server', 'Content-Type',
+               'Last-Modified', 'ETag')
+
+    def __init__(self, root, segment_size=4 * 1024 * 1024, concurrency=4):
+        self.root = root
+        self.segment_size = segment_size
+        self.concurrency = concurrency
+        # (key, segment) -> task downloading that segment
+        self.pending = {}
+
+    def hash_request(self, request):
+        hash = request_hash(request)
+        return os.path.join(hash[0:2], hash[2:4], hash + '.seg')
+
+    def _path(self, key, *parts):
+        return os.path.join(self.root, key, *parts)
+
+    def _write(self, path, data):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get_index(self, key):
+        try:
+            with open(self._path(key, 'index.json'), 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def create(self, key, url, headers, length):
+        index = {
+            'url': url,
+            'length': length,
+            'segment_size': self.segment_size,
+            'headers': dict((h, headers[h]) for h in self.HEADERS
+                            if h in headers),
+        }
+        d = self._path(key)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        self._write(self._path(key, 'index.json'),
+                    json.dumps(index).encode('utf-8'))
+        return index
+
+    def remove(self, key):
+        shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def segment_count(self, index):
+        size = index['segment_size']
+        return (index['length'] + size - 1) // size
+
+    def segment_range(self, index, segment):
+        """Returns the inclusive byte range covered by a segment"""
+        size = index['segment_size']
+        start = segment * size
+        return start, min(start + size, index['length']) - 1
+
+    def segments_for_range(self, index, start, end):
+        size = index['segment_size']
+        return range(start // size, end // size + 1)
+
+    def has_segment(self, key, segment):
+        return os.path.exists(self._path(key, '%08d' % segment))
+
+    def read_segment(self, key, segment):
+        with open(self._path(key, '%08d' % segment), 'rb') as f:
+            return f.read()
+
+    def write_segment(self, key, segment, data):
+        self._write(self._path(key, '%08d' % segment), data)
 
 
 def build_request(hash, timestamp):
@@ -343,12 +625,20 @@ class CacheHandler(tornado.web.RequestHandler):
         else:
             url = self.get_argument('url')
             method = self.get_argument('method', 'GET')
-            request = HTTPRequest(url, method=method)
-            response = self.cache.get(request)
+            headers = dict(
+                (h, self.request.headers[h])
+                for h in ('X-Wayback-Timestamp', 'X-Wayback-Within')
+                if h in self.request.headers)
+            request = HTTPRequest(url, method=method, headers=headers)
+            try:
+                response = self.cache.get(request)
+            except WaybackPageNotFound:
+                response = None
         if not response:
             self.set_status(404)
             self.write('Page not found in cache')
             self.finish()
+            return
         self.set_status(response.code)
         for header in ('Date', 'Cache-Control', 'Server',
                        'Content-Type', 'Location',
@@ -373,7 +663,8 @@ class CacheHandler(tornado.web.RequestHandler):
                 'error': None,
                 'code': 404,
                 'headers': {},
-                'body': 'meh'
+                'body': 'meh',
+                'body_encoding': None  # or 'base64'
             },
             'wayback': {
                 'timestamp': 123456
@@ -389,14 +680,17 @@ class CacheHandler(tornado.web.RequestHandler):
         request._wb_force = True
         wayback = data.get('wayback')
         if wayback:
-            for k, v in wayback.iteritems():
+            for k, v in wayback.items():
                 setattr(request, '_wb_' + k, v)
+        body = data['response']['body']
+        if data['response'].get('body_encoding') == 'base64':
+            body = base64.b64decode(body)
         response = HTTPResponse(
             url=data['response']['url'],
             error=data['response'].get('error'),
             code=data['response'].get('code', 200),
             headers=data['response'].get('headers', {}),
-            body=data['response']['body']
+            body=body
         )
         self.cache[request] = response
         self.write('ok')
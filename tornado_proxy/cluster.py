@@ -0,0 +1,196 @@
+"""Cooperative caching between proxy nodes
+
+Each cache key is owned by one node of the cluster, chosen by consistent
+hashing with virtual nodes, so adding or removing a node only moves the keys
+it owns. On a local cache miss a node asks the owner for the response through
+the owner's /cache/ endpoint before going to the origin, and responses it
+fetches from the origin are stored at the owner, so each object is fetched
+and stored once across the cluster.
+
+Peers are health checked periodically; keys owned by a peer that is down are
+handled by the next healthy node on the ring.
+"""
+
+import base64
+import bisect
+import hashlib
+import json
+import logging
+import urllib.parse
+
+import tornado.httpclient
+import tornado.ioloop
+import tornado.web
+
+logger = logging.getLogger('tornado.proxy.cluster')
+
+
+def ring_hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """A consistent hash ring with vnodes points per node"""
+
+    def __init__(self, nodes, vnodes=100):
+        self.nodes = list(nodes)
+        self.points = sorted(
+            (ring_hash('%s#%d' % (node, i)), node)
+            for node in self.nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def nodes_for(self, key):
+        """Yields every node once, in ring order starting at the key's owner"""
+        seen = set()
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def owner(self, key):
+        return next(self.nodes_for(key))
+
+
+class PeerCluster(object):
+    """The proxy nodes sharing their caches
+
+    node is the base URL other nodes reach this one at (for example
+    ``http://10.0.0.1:8888``), peers are the base URLs of the other nodes.
+    A peer is marked down after ``max_failures`` failed lookups or health
+    checks in a row, and up again after a successful health check. timeout
+    bounds connecting to a peer and health checks. Lookups and stores carry
+    whole responses, so they get their own lookup_timeout and store_timeout,
+    and a transfer failing after the peer answered doesn't count against it,
+    nor do failed stores.
+    """
+
+    def __init__(self, node, peers, vnodes=100, check_interval=5.0,
+                 timeout=1.0, max_failures=2, lookup_timeout=10.0,
+                 store_timeout=30.0):
+        self.node = node
+        self.peers = [peer for peer in peers if peer != node]
+        self.ring = HashRing([node] + self.peers, vnodes)
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.lookup_timeout = lookup_timeout
+        self.store_timeout = store_timeout
+        self.max_failures = max_failures
+        self.failures = dict((peer, 0) for peer in self.peers)
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self._periodic = None
+
+    def start(self):
+        """Starts the periodic peer health checks on the current IOLoop"""
+        self._periodic = tornado.ioloop.PeriodicCallback(
+            self.check_peers, self.check_interval * 1000)
+        self._periodic.start()
+
+    def stop(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+
+    def is_healthy(self, peer):
+        return self.failures[peer] < self.max_failures
+
+    def owner(self, key):
+        """Returns the healthy peer owning a key, or None if this node owns
+        it (or should handle it because the owners are down)"""
+        for node in self.ring.nodes_for(key):
+            if node == self.node:
+                return None
+            if self.is_healthy(node):
+                return node
+        return None
+
+    def _failed(self, peer, error):
+        self.failures[peer] += 1
+        if self.failures[peer] == self.max_failures:
+            logger.warning('Peer %s is down: %s', peer, error)
+
+    def _succeeded(self, peer):
+        if not self.is_healthy(peer):
+            logger.warning('Peer %s is up', peer)
+        self.failures[peer] = 0
+
+    async def _fetch(self, peer, path, timeout=None, check_health=True,
+                     **kwargs):
+        """Requests a path from a peer, returning None on connection errors,
+        timeouts and server errors of the peer itself, which count as
+        failures of the peer if check_health is set (unless the peer had
+        started answering)"""
+        # header lines received, i.e. whether the peer answered
+        answered = []
+        try:
+            response = await self.client.fetch(
+                peer + path, connect_timeout=self.timeout,
+                request_timeout=timeout or self.timeout, raise_error=False,
+                header_callback=answered.append, **kwargs)
+        except Exception as e:
+            response = None
+            error = e
+            check_health = check_health and not answered
+        else:
+            error = response.error
+            # cached responses keep their origin status, 5xx included
+            if response.code < 500 or \
+                    'X-Proxy-Cache-Key' in response.headers:
+                error = None
+        if error is not None:
+            if check_health:
+                self._failed(peer, error)
+            else:
+                logger.warning('Request to peer %s failed: %s', peer, error)
+            return None
+        if check_health:
+            self._succeeded(peer)
+        return response
+
+    async def check_peers(self):
+        for peer in self.peers:
+            await self._fetch(peer, '/cluster/health/')
+
+    async def lookup(self, peer, request, headers=None):
+        """Asks a peer for the cached response to a request, returning None
+        if it doesn't have it. headers are passed on to the peer's cache
+        lookup (e.g. X-Wayback-Timestamp)."""
+        query = urllib.parse.urlencode({
+            'url': request.url, 'method': request.method})
+        response = await self._fetch(peer, '/cache/?' + query,
+                                     timeout=self.lookup_timeout,
+                                     headers=headers)
+        # cached responses can have any status, but always have a key
+        if response is None or 'X-Proxy-Cache-Key' not in response.headers:
+            return None
+        return response
+
+    async def store(self, peer, request, response):
+        """Stores a response in a peer's cache, returning whether it
+        succeeded"""
+        data = {
+            'request': {
+                'method': request.method,
+                'url': request.url,
+            },
+            'response': {
+                'url': response.effective_url or request.url,
+                'code': response.code,
+                'headers': dict(response.headers),
+                'body': base64.b64encode(response.body or b'').decode('ascii'),
+                'body_encoding': 'base64',
+            },
+        }
+        response = await self._fetch(peer, '/cache/', method='POST',
+                                     body=json.dumps(data),
+                                     timeout=self.store_timeout,
+                                     check_health=False)
+        return response is not None and response.code == 200
+
+
+class PeerHealthHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.write('ok')
@@ -0,0 +1,233 @@
+"""Speculative prefetching of the subresources of HTML pages
+
+When the proxy serves an HTML page, the Prefetcher parses it incrementally
+and queues the stylesheets, scripts, images and icons it references on the
+same site. A background fetcher with its own HTTP client downloads them into
+the cache, within its own concurrency budget and per-host limit, so the
+requests the browser makes next are cache hits.
+
+Only plain http URLs are prefetched: browsers load https resources through
+CONNECT tunnels, which bypass the cache. URLs already cached, queued or being
+prefetched are skipped, and a client request for a URL being prefetched waits
+for the prefetch instead of fetching it a second time. With a PeerCluster,
+URLs owned by a peer are looked up in and stored at that peer, like the
+proxy's own requests.
+
+Subresources are looked up in the cache with the X-Wayback-Within header of
+the page request, like the browser's own requests for them. Pages replayed
+from a past version (requested with X-Wayback-Timestamp) are not scanned:
+the origin only has the current versions of their subresources, which
+replay lookups wouldn't find anyway.
+"""
+
+import asyncio
+import collections
+import html.parser
+import ipaddress
+import logging
+import urllib.parse
+
+import tornado.httpclient
+import tornado.ioloop
+import tornado.web
+
+from tornado_proxy.cache import get_content_charset, request_hash
+
+logger = logging.getLogger('tornado.proxy.prefetch')
+
+# <link rel="..."> values referencing subresources
+LINK_RELS = frozenset(['stylesheet', 'icon', 'shortcut', 'preload',
+                       'modulepreload', 'apple-touch-icon'])
+
+
+def site(url):
+    """Returns the site of a URL, approximated by the last two labels of its
+    host name (no public suffix list is used), or the whole host for IP
+    addresses"""
+    host = urllib.parse.urlsplit(url).hostname or ''
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        return '.'.join(host.split('.')[-2:])
+
+
+class SubresourceParser(html.parser.HTMLParser):
+    """Collects the URLs of the subresources referenced by an HTML page, in
+    document order"""
+
+    def __init__(self, base_url):
+        super(SubresourceParser, self).__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.urls = []
+        self._seen = set()
+
+    def _add(self, url):
+        if not url:
+            return
+        url = urllib.parse.urljoin(self.base_url, url.strip())
+        url = urllib.parse.urldefrag(url)[0]
+        if url not in self._seen and url.startswith(('http://', 'https://')):
+            self._seen.add(url)
+            self.urls.append(url)
+
+    def _add_srcset(self, srcset):
+        # "small.png 1x, large.png 2x"
+        for candidate in (srcset or '').split(','):
+            self._add(candidate.strip().split(' ')[0])
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'base' and attrs.get('href'):
+            self.base_url = urllib.parse.urljoin(self.base_url, attrs['href'])
+        elif tag == 'link':
+            rels = set((attrs.get('rel') or '').lower().split())
+            if rels & LINK_RELS:
+                self._add(attrs.get('href'))
+        elif tag == 'script':
+            self._add(attrs.get('src'))
+        elif tag == 'img':
+            self._add(attrs.get('src'))
+            self._add_srcset(attrs.get('srcset'))
+        elif tag == 'source':
+            self._add_srcset(attrs.get('srcset'))
+        elif tag == 'video':
+            self._add(attrs.get('poster'))
+
+
+class Prefetcher(object):
+    """Fetches the subresources of HTML pages into a cache in the background
+
+    At most concurrency prefetches run at once, and at most per_host to the
+    same host. URLs beyond max_queue waiting prefetches are dropped. Only the
+    headers in FORWARD_HEADERS are copied from the page request.
+    """
+
+    FORWARD_HEADERS = ('User-Agent', 'Accept-Language', 'X-Wayback-Within')
+
+    def __init__(self, cache, cluster=None, concurrency=4, per_host=2,
+                 max_queue=1000, chunk_size=65536):
+        self.cache = cache
+        self.cluster = cluster
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.max_queue = max_queue
+        self.chunk_size = chunk_size
+        # a separate client, so prefetches don't take up the connections
+        # used for client requests
+        self.client = tornado.httpclient.AsyncHTTPClient(
+            force_instance=True, max_clients=concurrency)
+        self.queue = collections.deque()
+        self.queued = set()
+        # url -> future resolved when the prefetch is done
+        self.in_flight = {}
+        self.hosts = collections.Counter()
+        self.counts = collections.Counter()
+
+    def stats(self):
+        stats = {
+            'queued': len(self.queue),
+            'in_flight': len(self.in_flight),
+        }
+        for name in ('fetched', 'cached', 'failed', 'dropped', 'replays'):
+            stats[name] = self.counts[name]
+        return stats
+
+    def is_html(self, response):
+        content_type = response.headers.get('Content-Type', '')
+        return content_type.split(';')[0].strip().lower() == 'text/html'
+
+    async def scan(self, url, response, headers):
+        """Parses an HTML page a chunk at a time, yielding to the IOLoop in
+        between, and queues its same-site subresources. headers are the
+        headers of the page request, including its wayback headers."""
+        if 'X-Wayback-Timestamp' in headers:
+            self.counts['replays'] += 1
+            return
+        parser = SubresourceParser(url)
+        text = response.body.decode(get_content_charset(response.headers),
+                                    'replace')
+        for i in range(0, len(text), self.chunk_size):
+            parser.feed(text[i:i + self.chunk_size])
+            await asyncio.sleep(0)
+        parser.close()
+        headers = dict((h, headers[h]) for h in self.FORWARD_HEADERS
+                       if h in headers)
+        page_site = site(url)
+        for subresource in parser.urls:
+            if subresource.startswith('http://') and \
+                    site(subresource) == page_site:
+                self.enqueue(subresource, headers)
+
+    def enqueue(self, url, headers=None):
+        if url in self.queued or url in self.in_flight:
+            return
+        if len(self.queue) >= self.max_queue:
+            self.counts['dropped'] += 1
+            return
+        self.queue.append((url, headers))
+        self.queued.add(url)
+        self._start()
+
+    def _start(self):
+        while self.queue and len(self.in_flight) < self.concurrency:
+            # the first queued url whose host isn't at its limit
+            for i, (url, headers) in enumerate(self.queue):
+                host = urllib.parse.urlsplit(url).netloc
+                if self.hosts[host] < self.per_host:
+                    break
+            else:
+                return
+            del self.queue[i]
+            self.queued.discard(url)
+            self.hosts[host] += 1
+            self.in_flight[url] = asyncio.Future()
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._fetch, url, host, headers)
+
+    async def _fetch(self, url, host, headers):
+        try:
+            request = tornado.httpclient.HTTPRequest(
+                url, headers=headers, follow_redirects=False)
+            peer = None
+            if self.cluster is not None:
+                peer = self.cluster.owner(request_hash(request))
+            if peer is not None:
+                wayback_headers = dict(
+                    (h, v) for h, v in (headers or {}).items()
+                    if h == 'X-Wayback-Within')
+                cached = await self.cluster.lookup(
+                    peer, request, wayback_headers) is not None
+            else:
+                cached = request in self.cache
+            if cached:
+                self.counts['cached'] += 1
+                return
+            response = await self.client.fetch(request, raise_error=False)
+            if response.code == 200:
+                # keys owned by a peer are only stored there, unless it
+                # can't be reached
+                if peer is None or \
+                        not await self.cluster.store(peer, request, response):
+                    self.cache[request] = response
+                self.counts['fetched'] += 1
+            else:
+                self.counts['failed'] += 1
+        except Exception as e:
+            logger.debug('Error prefetching %s: %s', url, e)
+            self.counts['failed'] += 1
+        finally:
+            self.hosts[host] -= 1
+            if not self.hosts[host]:
+                del self.hosts[host]
+            self.in_flight.pop(url).set_result(None)
+            self._start()
+
+
+class PrefetchHandler(tornado.web.RequestHandler):
+
+    def initialize(self, prefetcher):
+        self.prefetcher = prefetcher
+
+    def get(self):
+        self.write(self.prefetcher.stats())
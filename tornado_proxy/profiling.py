@@ -0,0 +1,272 @@
+"""Diagnostics for slow requests
+
+Every proxied request gets a PhaseTimer recording how long it spent in each
+phase (cache lookup, SQLite index query, gzip work, upstream fetch, writing to
+the client). Code times a phase with ``with phase('name'):``, which is a no-op
+outside a timed request. Phases nest, so e.g. ``sqlite`` time is also counted
+in the enclosing ``cache_lookup``.
+
+On top of that, a Diagnostics object holds the settings that can be changed at
+runtime through the admin endpoints:
+
+- a slow request log, listing the phases of requests slower than a threshold
+- a sampling profiler for the IOLoop thread, producing collapsed stacks that
+  can be fed to flamegraph.pl
+- a detector that logs the IOLoop thread's stack when a callback blocks the
+  loop for longer than a threshold
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import tornado.ioloop
+import tornado.web
+
+logger = logging.getLogger('tornado.proxy.profiling')
+
+_current_timer = contextvars.ContextVar('tornado_proxy_timer', default=None)
+
+
+class PhaseTimer(object):
+    """Accumulates the time a request spends in each phase"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    def activate(self):
+        """Makes this the timer used by phase() in the current context"""
+        _current_timer.set(self)
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def format(self):
+        return ' '.join('%s=%.1fms' % (name, duration * 1000)
+                        for name, duration in self.phases.items())
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the enclosed block as a phase of the current request"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def format_stack(frame):
+    """Formats a stack as a collapsed ``file:function;...`` line, outermost
+    frame first"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%s' % (code.co_filename, code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler(object):
+    """Samples the stack of a thread at a fixed interval from a background
+    thread, counting how often each stack is seen"""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='tornado-proxy-profiler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[format_stack(frame)] += 1
+            del frame
+
+    def output(self):
+        """Returns the samples in the collapsed stack format used by
+        flamegraph.pl: one ``stack count`` line per distinct stack"""
+        return ''.join('%s %d\n' % (stack, count)
+                       for stack, count in self.samples.most_common())
+
+
+class BlockingDetector(object):
+    """Logs the stack of the IOLoop thread when the loop is blocked
+
+    A callback on the loop records a heartbeat every threshold / 2 seconds,
+    and a watchdog thread reports the loop thread's stack when the heartbeat
+    is more than threshold seconds old.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._reported = False
+        self._stop = threading.Event()
+        self._periodic = tornado.ioloop.PeriodicCallback(
+            self._beat, threshold * 1000 / 2)
+        self._thread = threading.Thread(target=self._run,
+                                        name='tornado-proxy-blocking')
+        self._thread.daemon = True
+
+    def start(self):
+        self._periodic.start()
+        self._thread.start()
+
+    def stop(self):
+        self._periodic.stop()
+        self._stop.set()
+
+    def _beat(self):
+        self.heartbeat = time.monotonic()
+        self._reported = False
+
+    def _run(self):
+        while not self._stop.wait(self.threshold / 2):
+            blocked = time.monotonic() - self.heartbeat
+            if blocked < self.threshold or self._reported:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self._reported = True
+            logger.warning('IOLoop blocked for over %.1fms:\n%s',
+                           blocked * 1000,
+                           ''.join(traceback.format_stack(frame)))
+            del frame
+
+
+class Diagnostics(object):
+    """The runtime diagnostics settings shared by the proxy handlers
+
+    Thresholds are in seconds, None disables the feature. Methods that start
+    threads or loop callbacks must be called on the IOLoop thread.
+    """
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold
+        self.blocking_detector = None
+        self.profiler = None
+
+    @property
+    def blocking_threshold(self):
+        if self.blocking_detector is None:
+            return None
+        return self.blocking_detector.threshold
+
+    def set_blocking_threshold(self, threshold):
+        if self.blocking_detector is not None:
+            self.blocking_detector.stop()
+            self.blocking_detector = None
+        if threshold:
+            self.blocking_detector = BlockingDetector(threshold)
+            self.blocking_detector.start()
+
+    def start_profiler(self, interval=0.005):
+        self.stop_profiler()
+        self.profiler = SamplingProfiler(threading.get_ident(), interval)
+        self.profiler.start()
+
+    def stop_profiler(self):
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+
+    def request_finished(self, handler, timer):
+        """Logs the phase breakdown of a finished request if it was slow"""
+        if self.slow_threshold is None:
+            return
+        elapsed = timer.elapsed()
+        if elapsed >= self.slow_threshold:
+            logger.warning('Slow request %s %s %d %.1fms: %s',
+                           handler.request.method, handler.request.uri,
+                           handler.get_status(), elapsed * 1000,
+                           timer.format())
+
+    def status(self):
+        return {
+            'slow_threshold': self.slow_threshold,
+            'blocking_threshold': self.blocking_threshold,
+            'profiling': self.profiler is not None and self.profiler.running,
+        }
+
+
+class DiagnosticsHandler(tornado.web.RequestHandler):
+
+    def initialize(self, diagnostics):
+        self.diagnostics = diagnostics
+
+    def get(self):
+        self.write(self.diagnostics.status())
+
+    def post(self):
+        """
+        data = {
+            'slow_threshold': 0.5,
+            'blocking_threshold': 0.1
+        }
+        """
+        data = json.loads(self.request.body)
+        if 'slow_threshold' in data:
+            self.diagnostics.slow_threshold = data['slow_threshold']
+        if 'blocking_threshold' in data:
+            self.diagnostics.set_blocking_threshold(data['blocking_threshold'])
+        self.write(self.diagnostics.status())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+
+    def initialize(self, diagnostics):
+        self.diagnostics = diagnostics
+
+    def get(self):
+        """Downloads the samples of the last profiler run"""
+        profiler = self.diagnostics.profiler
+        if profiler is None:
+            self.set_status(404)
+            self.write('No profile has been recorded')
+            return
+        self.set_header('Content-Type', 'text/plain')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="proxy-profile.txt"')
+        self.write(profiler.output())
+
+    def post(self):
+        """Starts the profiler, discarding the previous samples"""
+        interval = float(self.get_argument('interval', 0.005))
+        self.diagnostics.start_profiler(interval)
+        self.write('ok')
+
+    def delete(self):
+        """Stops the profiler, keeping its samples for download"""
+        self.diagnostics.stop_profiler()
+        self.write('ok')
@@ -25,50 +25,241 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import socket
+import asyncio
+import collections
 import logging
+import time
+import weakref
 
 import tornado.httpclient
-import tornado.httpserver
 import tornado.ioloop
 import tornado.iostream
+import tornado.tcpclient
 import tornado.web
+from tornado.httputil import HTTPHeaders
 
-from tornado_proxy.cache import WaybackPageNotFound
+from tornado_proxy.cache import (WaybackPageNotFound, parse_range,
+                                 request_hash)
+from tornado_proxy.profiling import PhaseTimer, phase
 
 __all__ = ['ProxyHandler']
 
 logger = logging.getLogger('tornado.proxy')
 
+# IOLoop -> {segment size: client}
+_segment_clients = weakref.WeakKeyDictionary()
+
+
+def segment_client(segment_size):
+    """Returns the HTTP client used for segment downloads on the current
+    IOLoop. Its max_body_size is the segment size, so a response carrying the
+    whole object (when it changed upstream) is aborted rather than
+    buffered."""
+    clients = _segment_clients.setdefault(tornado.ioloop.IOLoop.current(), {})
+    if segment_size not in clients:
+        clients[segment_size] = tornado.httpclient.AsyncHTTPClient(
+            force_instance=True, max_body_size=segment_size)
+    return clients[segment_size]
+
+
+class SegmentFetcher(object):
+    """Fills missing segments of an object in a SegmentStore using upstream
+    Range requests.
+
+    Segments that another request is already downloading are waited on rather
+    than fetched twice.
+    """
+
+    def __init__(self, store, key, index, headers):
+        self.store = store
+        self.key = key
+        self.index = index
+        self.headers = headers
+        self.client = segment_client(store.segment_size)
+
+    async def fetch(self, segment):
+        """Waits until the segment is on disk, downloading it if needed"""
+        task = self.store.pending.get((self.key, segment))
+        if task is None:
+            if self.store.has_segment(self.key, segment):
+                return
+            task = asyncio.ensure_future(self._download(segment))
+            self.store.pending[(self.key, segment)] = task
+            task.add_done_callback(
+                lambda task: self._forget(segment, task))
+        # the download carries on if this request goes away, so the segment
+        # is still there for the next one
+        await asyncio.shield(task)
+
+    def _forget(self, segment, task):
+        del self.store.pending[(self.key, segment)]
+        if not task.cancelled():
+            # mark the exception as retrieved, the waiters log it
+            task.exception()
+
+    def _changed(self):
+        # the upstream object changed, so the segments we already have can't
+        # be combined with new ones
+        self.store.remove(self.key)
+
+    async def _download(self, segment):
+        start, end = self.store.segment_range(self.index, segment)
+        headers = HTTPHeaders(self.headers)
+        headers['Range'] = 'bytes=%d-%d' % (start, end)
+        # if the object changed upstream we get a 200 instead of a 206. Weak
+        # ETags aren't allowed in If-Range (RFC 7233), servers answer them
+        # with the whole object
+        etag = self.index['headers'].get('ETag')
+        last_modified = self.index['headers'].get('Last-Modified')
+        if etag and not etag.startswith('W/'):
+            headers['If-Range'] = etag
+        elif last_modified:
+            headers['If-Range'] = last_modified
+        # the status is known before a body too large for the client aborts
+        # the response
+        status = []
+
+        def header_callback(line):
+            if line.startswith('HTTP/'):
+                status.append(int(line.split()[1]))
+
+        req = tornado.httpclient.HTTPRequest(url=self.index['url'],
+            headers=headers, follow_redirects=False,
+            header_callback=header_callback)
+        try:
+            response = await self.client.fetch(req, raise_error=False)
+        except Exception:
+            if status and status[-1] == 200:
+                self._changed()
+            raise
+        if response.code == 206 and len(response.body) == end - start + 1:
+            self.store.write_segment(self.key, segment, response.body)
+            return
+        if response.code == 200:
+            self._changed()
+        raise response.error or Exception(
+            'Unexpected response %d for segment %d of %s' % (
+                response.code, segment, self.index['url']))
+
+
+async def relay(source, destination):
+    """Copies data from one stream to another until either is closed,
+    returning the number of bytes copied"""
+    copied = 0
+    try:
+        while True:
+            data = await source.read_bytes(65536, partial=True)
+            await destination.write(data)
+            copied += len(data)
+    except tornado.iostream.StreamClosedError:
+        pass
+    finally:
+        destination.close()
+    return copied
+
 
 class ProxyHandler(tornado.web.RequestHandler):
-    SUPPORTED_METHODS = ['GET', 'POST', 'CONNECT']
+    SUPPORTED_METHODS = ('GET', 'POST', 'CONNECT')
 
-    def initialize(self, cache):
+    def initialize(self, cache, segments=None, diagnostics=None,
+                   access_log=None, cluster=None, prefetcher=None):
         self.cache = cache
+        self.segments = segments
+        self.diagnostics = diagnostics
+        self.access_log = access_log
+        self.cluster = cluster
+        self.prefetcher = prefetcher
+        # access log fields, filled in while handling the request
+        self.cache_key = None
+        self.cache_status = 'none' if cache is None else 'miss'
+        self.bytes_sent = 0
+        self.wayback_timestamp = None
+        # the wayback cache consumes these headers during the lookup
+        self.wayback_headers = {}
+        # created here rather than in prepare(), which isn't called for
+        # requests Tornado rejects (e.g. unsupported methods)
+        self.timer = PhaseTimer()
+
+    def prepare(self):
+        self.timer.activate()
+
+    def on_finish(self):
+        if self.diagnostics is not None:
+            # on_finish runs inside finish(), so wait for the client_write
+            # phase around it to be recorded
+            tornado.ioloop.IOLoop.current().add_callback(
+                self.diagnostics.request_finished, self, self.timer)
+        if self.access_log is not None:
+            self.log_access()
+
+    def log_access(self, tunnel_duration=None):
+        self.access_log.record((
+            time.time(), self.request.method, self.request.uri,
+            self.get_status(), self.cache_key, self.cache_status,
+            self.timer.phases.get('upstream'), self.bytes_sent,
+            self.wayback_timestamp, tunnel_duration, self.timer.elapsed()))
 
-    @tornado.web.asynchronous
-    def get(self):
-        def handle_response(response, set_cache=True):
-            if response.error and not isinstance(response.error,
-                    tornado.httpclient.HTTPError):
-                self.set_status(500)
-                self.write('Internal server error:\n' + str(response.error))
-            else:
-                if set_cache and self.cache is not None:
-                    # add the response to the cache
-                    self.cache[req] = response
-                self.set_status(response.code)
-                for header in ('Date', 'Cache-Control', 'Server',
-                               'Content-Type', 'Location',
-                               'X-Proxy-Cache-Key', 'X-Wayback-Timestamp'):
-                    v = response.headers.get(header)
-                    if v:
-                        self.set_header(header, v)
-                if response.body:
-                    self.write(response.body)
+    def is_stale(self, response):
+        """Whether a cached wayback response is older than the cache's
+        default time range, which happens when an older version is asked
+        for with X-Wayback-Timestamp"""
+        within = getattr(self.cache, 'default_within', None)
+        timestamp = response.headers.get('X-Wayback-Timestamp')
+        return within is not None and timestamp is not None and \
+            int(timestamp) < time.time() - within
+
+    def handle_response(self, req, response, set_cache=True):
+        if response.error and not isinstance(response.error,
+                tornado.httpclient.HTTPClientError):
+            self.set_status(500)
+            self.write('Internal server error:\n' + str(response.error))
+        else:
+            if set_cache and self.cache is not None:
+                # add the response to the cache
+                self.cache[req] = response
+            self.set_status(response.code)
+            for header in ('Date', 'Cache-Control', 'Server',
+                           'Content-Type', 'Location',
+                           'X-Proxy-Cache-Key', 'X-Wayback-Timestamp'):
+                v = response.headers.get(header)
+                if v:
+                    self.set_header(header, v)
+            self.cache_key = response.headers.get('X-Proxy-Cache-Key')
+            wayback_timestamp = response.headers.get('X-Wayback-Timestamp')
+            if wayback_timestamp:
+                self.wayback_timestamp = int(wayback_timestamp)
+            if response.body:
+                self.write(response.body)
+                self.bytes_sent = len(response.body)
+        with phase('client_write'):
+            self.finish()
+        if self.prefetcher is not None and self.request.method == 'GET' \
+                and response.code == 200 and response.body and \
+                self.prefetcher.is_html(response):
+            # parse the page once it has been sent to the client
+            headers = HTTPHeaders(self.request.headers)
+            headers.update(self.wayback_headers)
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self.prefetcher.scan, req.url, response, headers)
+
+    async def fetch(self, req):
+        """Fetches a request upstream, returning None if it failed without a
+        response, in which case the error has already been written"""
+        client = tornado.httpclient.AsyncHTTPClient()
+        try:
+            with phase('upstream'):
+                response = await client.fetch(req, raise_error=False)
+        except Exception as e:
+            self.set_status(500)
+            self.write('Internal server error:\n' + str(e))
             self.finish()
+            return None
+        if 'connect' in response.time_info:
+            # only the curl client reports connection timings
+            self.timer.add('upstream_connect', response.time_info['connect'])
+        return response
 
+    async def get(self):
         body = self.request.body
         if self.request.method == 'GET' and not body:
             body = None
@@ -77,70 +268,219 @@ class ProxyHandler(tornado.web.RequestHandler):
             headers=self.request.headers, follow_redirects=False,
             allow_nonstandard_methods=True)
 
+        self.wayback_headers = dict(
+            (h, req.headers[h])
+            for h in ('X-Wayback-Timestamp', 'X-Wayback-Within')
+            if h in req.headers)
+
+        peer = None
+        if self.cluster is not None and self.cache is not None and \
+                self.request.method == 'GET' and body is None:
+            peer = self.cluster.owner(request_hash(req))
+
+        if self.prefetcher is not None and body is None:
+            pending = self.prefetcher.in_flight.get(req.url)
+            if pending is not None:
+                # wait for the prefetch to fill the cache rather than
+                # fetching the same URL twice
+                with phase('prefetch_wait'):
+                    await pending
+
+        not_found = None
         if self.cache is not None:
             try:
-                response = self.cache.get(req)
+                with phase('cache_lookup'):
+                    response = self.cache.get(req)
                 if response:
-                    return handle_response(response, False)
+                    self.cache_status = 'stale' if self.is_stale(response) \
+                        else 'hit'
+                    return self.handle_response(req, response, False)
             except WaybackPageNotFound as e:
-                # need to set the error code directly here, as 523 is not an
-                # official error code. It's similar to the 523 code CloudFlare
-                # returns, so it's appropriated here
-                self._status_code = 523
-                self._reason = 'WaybackPageNotFound'
-                self.write(
-                    "Could not find \"{0.url}\" in cache before {0.timestamp} "
-                    "within {0.within}\n".format(e))
-                self.finish()
-                return
-            except:
+                not_found = e
+            except Exception:
                 logger.exception("Error reading from cache")
 
-        client = tornado.httpclient.AsyncHTTPClient()
-        try:
-            client.fetch(req, handle_response)
-        except tornado.httpclient.HTTPError as e:
-            if hasattr(e, 'response') and e.response:
-                handle_response(e.response)
-            else:
-                self.set_status(500)
-                self.write('Internal server error:\n' + str(e))
-                self.finish()
-
-    @tornado.web.asynchronous
-    def post(self):
-        return self.get()
-
-    @tornado.web.asynchronous
-    def connect(self):
-        host, port = self.request.uri.split(':')
-        client = self.request.connection.stream
+        if peer is not None:
+            with phase('peer_lookup'):
+                response = await self.cluster.lookup(peer, req,
+                                                     self.wayback_headers)
+            if response is not None:
+                self.cache_status = 'peer'
+                return self.handle_response(req, response, False)
 
-        def read_from_client(data):
-            upstream.write(data)
+        if not_found is not None:
+            # 523 is not an official error code. It's similar to the 523
+            # code CloudFlare returns, so it's appropriated here
+            self.set_status(523, 'WaybackPageNotFound')
+            self.write(
+                "Could not find \"{0.url}\" in cache before {0.timestamp} "
+                "within {0.within}\n".format(not_found))
+            self.finish()
+            return
 
-        def read_from_upstream(data):
-            client.write(data)
+        if self.segments is not None and self.request.method == 'GET' \
+                and body is None:
+            return await self.get_segmented(req)
 
-        def client_close(data=None):
-            if upstream.closed():
-                return
-            if data:
-                upstream.write(data)
-            upstream.close()
+        response = await self.fetch(req)
+        if response is not None:
+            # responses for keys owned by a peer are only stored there
+            self.handle_response(req, response, set_cache=peer is None)
+            if peer is not None:
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                    self.store_at_peer, peer, req, response)
 
-        def upstream_close(data=None):
-            if client.closed():
-                return
-            if data:
-                client.write(data)
-            client.close()
+    async def store_at_peer(self, peer, req, response):
+        """Stores a response in the cache of the peer owning it, or in the
+        local cache if the peer can't be reached"""
+        if not await self.cluster.store(peer, req, response):
+            self.cache[req] = response
 
-        def start_tunnel():
-            client.read_until_close(client_close, read_from_client)
-            upstream.read_until_close(upstream_close, read_from_upstream)
-            client.write(b'HTTP/1.0 200 Connection established\r\n\r\n')
+    async def get_segmented(self, req):
+        """Fetches a GET request through the segment store
+
+        Objects already in the store are served from their segments. Otherwise
+        the first segment is requested upstream as a probe: if the response
+        shows the object spans several segments it is added to the store and
+        the rest is filled in parallel, otherwise the probe response is
+        handled like a normal response.
+        """
+        store = self.segments
+        key = store.hash_request(req)
+        index = store.get_index(key)
+        if index is not None:
+            self.cache_status = 'hit'
+            return await self.serve_segments(key, index)
+        self.cache_status = 'miss'
+
+        headers = HTTPHeaders(req.headers)
+        headers['Range'] = 'bytes=0-%d' % (store.segment_size - 1)
+        probe = tornado.httpclient.HTTPRequest(url=req.url, headers=headers,
+            follow_redirects=False)
+        response = await self.fetch(probe)
+        if response is None:
+            return
+        length = None
+        if response.code == 206:
+            try:
+                length = int(response.headers['Content-Range'].rsplit('/')[1])
+            except (KeyError, IndexError, ValueError):
+                pass
+        elif response.code != 416:
+            # empty objects can't satisfy any range, everything else is a
+            # complete response
+            response.request = req
+            return self.handle_response(req, response)
 
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        upstream = tornado.iostream.IOStream(s)
-        upstream.connect((host, int(port)), start_tunnel)
+        if length is not None and length <= store.segment_size:
+            # the probe contains the whole object
+            response.request = req
+            response.code = 200
+            del response.headers['Content-Range']
+            return self.handle_response(req, response)
+        if length is None or len(response.body) != store.segment_size:
+            response = await self.fetch(req)
+            if response is not None:
+                self.handle_response(req, response)
+            return
+
+        index = store.create(key, req.url, response.headers, length)
+        store.write_segment(key, 0, response.body)
+        await self.serve_segments(key, index)
+
+    async def serve_segments(self, key, index):
+        """Serves an object (or the requested Range of it) from the segment
+        store, writing segments to the client in order while the next ones
+        are fetched in parallel"""
+        store = self.segments
+        length = index['length']
+        try:
+            byte_range = parse_range(self.request.headers.get('Range'), length)
+        except ValueError:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */%d' % length)
+            self.finish()
+            return
+        if byte_range is None:
+            start, end = 0, length - 1
+        else:
+            start, end = byte_range
+            self.set_status(206)
+            self.set_header('Content-Range',
+                            'bytes %d-%d/%d' % (start, end, length))
+        for header, value in index['headers'].items():
+            self.set_header(header, value)
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('Content-Length', end - start + 1)
+        self.set_header('X-Proxy-Cache-Key', key)
+        self.cache_key = key
+
+        fetcher = SegmentFetcher(store, key, index, self.request.headers)
+        segments = collections.deque(
+            store.segments_for_range(index, start, end))
+        # fetches[i] is the download of segments[i]
+        fetches = collections.deque()
+        try:
+            while segments:
+                while len(fetches) < min(store.concurrency, len(segments)):
+                    fetches.append(asyncio.ensure_future(
+                        fetcher.fetch(segments[len(fetches)])))
+                segment = segments.popleft()
+                try:
+                    with phase('segment_wait'):
+                        await fetches.popleft()
+                except Exception as e:
+                    logger.error('Error fetching segment %d of %s: %s',
+                                 segment, index['url'], e)
+                    if self._headers_written:
+                        # too late to report the error, so cut the response
+                        # short
+                        self.request.connection.close()
+                    else:
+                        self.clear()
+                        self.set_status(500)
+                        self.write('Internal server error:\n' + str(e))
+                        self.finish()
+                    return
+                seg_start, seg_end = store.segment_range(index, segment)
+                data = store.read_segment(key, segment)
+                data = data[max(start, seg_start) - seg_start:
+                            min(end, seg_end) - seg_start + 1]
+                with phase('client_write'):
+                    self.write(data)
+                    await self.flush()
+                self.bytes_sent += len(data)
+        except tornado.iostream.StreamClosedError:
+            # the client went away
+            return
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
+        self.finish()
+
+    async def post(self):
+        return await self.get()
+
+    async def connect(self):
+        host, port = self.request.uri.split(':')
+        client = self.detach()
+        try:
+            upstream = await tornado.tcpclient.TCPClient().connect(
+                host, int(port))
+        except (OSError, tornado.iostream.StreamClosedError) as e:
+            logger.error('Could not connect to %s: %s', self.request.uri, e)
+            self.set_status(502)
+            try:
+                await client.write(b'HTTP/1.0 502 Bad Gateway\r\n\r\n')
+            except tornado.iostream.StreamClosedError:
+                pass
+            client.close()
+            if self.access_log is not None:
+                self.log_access()
+            return
+        await client.write(b'HTTP/1.0 200 Connection established\r\n\r\n')
+        start = time.monotonic()
+        _, self.bytes_sent = await asyncio.gather(
+            relay(client, upstream), relay(upstream, client))
+        if self.access_log is not None:
+            self.log_access(tunnel_duration=time.monotonic() - start)